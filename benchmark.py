@@ -0,0 +1,237 @@
+"""
+    Benchmarks for the hot paths of LightDHT: the bencode codec, compact
+    node info, the routing tables and the request handler.
+
+    Usage:
+
+        python benchmark.py                          # run all, print JSON
+        python benchmark.py --only routing --sizes 10000
+        python benchmark.py --save benchmark-baseline.json
+        python benchmark.py --compare benchmark-baseline.json
+
+    With --compare, any benchmark that got more than --threshold (20% by
+    default) slower than the baseline is reported, and the exit status is
+    non-zero. Baselines are only meaningful on the machine they were
+    recorded on.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import struct
+import sys
+import time
+
+from bencode import bencode, bdecode
+from lightdht import DHT, Node, decode_nodes, encode_nodes
+from routingtable import FlatRoutingTable, PrefixRoutingTable
+
+
+def measure(fn, min_time=0.2, max_calls=None):
+    """
+        Call fn() repeatedly for at least min_time seconds; return the
+        number of calls and the seconds taken per call.
+    """
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time and (max_calls is None or calls < max_calls):
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - started
+    return calls, elapsed / calls
+
+
+def result(calls, per_call, ops_per_call=1):
+    return {"calls": calls,
+            "seconds_per_op": per_call / ops_per_call,
+            "ops_per_sec": ops_per_call / per_call}
+
+
+def random_nodes(n, rng):
+    return [(rng.getrandbits(160).to_bytes(20, "big"),
+             Node(("%d.%d.%d.%d" % tuple(rng.randrange(1, 255) for _ in range(4)),
+                   rng.randrange(1024, 65535))))
+            for _ in range(n)]
+
+
+#
+# Codec
+
+def bench_codec(args, rng):
+    nodes = random_nodes(8, rng)
+    packets = {
+        "ping_query": {"t": b"aa\x00\x01", "y": "q", "q": "ping",
+                       "a": {"id": os.urandom(20)}, "v": b"LT\x01\x02"},
+        "get_peers_query": {"t": b"aa\x00\x01", "y": "q", "q": "get_peers",
+                            "a": {"id": os.urandom(20), "info_hash": os.urandom(20)},
+                            "v": b"LT\x01\x02"},
+        "find_node_reply": {"t": b"aa\x00\x01", "y": "r",
+                            "r": {"id": os.urandom(20), "nodes": encode_nodes(nodes)}},
+        "get_peers_values_reply": {"t": b"aa\x00\x01", "y": "r",
+                                   "r": {"id": os.urandom(20), "token": os.urandom(8),
+                                         "values": [os.urandom(6) for _ in range(50)]}},
+    }
+    results = {}
+    for name, packet in packets.items():
+        data = bencode(packet)
+        results["bencode." + name] = result(*measure(lambda: bencode(packet), args.min_time))
+        results["bdecode." + name] = result(*measure(lambda: bdecode(data), args.min_time))
+
+    encoded = encode_nodes(nodes)
+    results["encode_nodes.8"] = result(*measure(lambda: encode_nodes(nodes), args.min_time))
+    results["decode_nodes.8"] = result(*measure(lambda: list(decode_nodes(encoded)), args.min_time))
+    return results
+
+
+#
+# Routing tables
+
+def bench_routing(args, rng):
+    results = {}
+    for size in args.sizes:
+        nodes = random_nodes(size, rng)
+        extra = random_nodes(1000, rng)
+        targets = [rng.getrandbits(160).to_bytes(20, "big") for _ in range(1000)]
+        for cls in (FlatRoutingTable, PrefixRoutingTable):
+            name = "%s.%d" % (cls.__name__, size)
+            rt = cls()
+            for node_id, node in nodes:
+                rt.update_entry(node_id, node)
+
+            def update():
+                for node_id, node in extra:
+                    rt.update_entry(node_id, node)
+            calls, per_call = measure(update, args.min_time)
+            results[name + ".update_entry"] = result(calls, per_call, len(extra))
+
+            it = iter(range(1 << 62))
+            def close():
+                rt.get_close_nodes(targets[next(it) % len(targets)])
+            results[name + ".get_close_nodes"] = result(*measure(close, args.min_time))
+            del rt
+    return results
+
+
+#
+# Request handler, end to end over loopback UDP
+
+def bench_handler(args, rng):
+    dht = DHT(0, os.urandom(20), b"BM\x00\x00")
+    for node_id, node in random_nodes(10000, rng):
+        dht._rt.update_entry(node_id, node)
+    server = dht._server
+    server.start()
+    server.handler = dht.handler
+    c = ("127.0.0.1", server._transport.getsockname()[1])
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(1.0)
+    client_id = os.urandom(20)
+    queries = {
+        "ping": lambda: {"y": "q", "q": "ping", "a": {"id": client_id}},
+        "find_node": lambda: {"y": "q", "q": "find_node",
+                              "a": {"id": client_id, "target": os.urandom(20)}},
+        "get_peers": lambda: {"y": "q", "q": "get_peers",
+                              "a": {"id": client_id, "info_hash": os.urandom(20)}},
+    }
+    results = {}
+    window = 32
+    try:
+        for name, make in queries.items():
+            packets = [bencode(dict(make(), t=struct.pack("!H", i))) for i in range(1024)]
+            sent = received = 0
+            started = time.perf_counter()
+            while time.perf_counter() - started < args.min_time * 5:
+                # Keep a window of queries in flight
+                while sent - received < window:
+                    client.sendto(packets[sent % len(packets)], c)
+                    sent += 1
+                try:
+                    client.recvfrom(4096)
+                except socket.timeout:
+                    break
+                received += 1
+            elapsed = time.perf_counter() - started
+            # Drain what is still in flight
+            try:
+                while received < sent:
+                    client.recvfrom(4096)
+                    received += 1
+            except socket.timeout:
+                pass
+            results["handler." + name] = {"calls": received,
+                                          "seconds_per_op": elapsed / max(received, 1),
+                                          "ops_per_sec": received / elapsed}
+    finally:
+        client.close()
+        server.shutdown()
+    return results
+
+
+BENCHMARKS = {
+    "codec": bench_codec,
+    "routing": bench_routing,
+    "handler": bench_handler,
+}
+
+
+def compare(results, baseline, threshold):
+    """ Names of the benchmarks more than threshold slower than baseline """
+    regressions = []
+    for name, r in sorted(results.items()):
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        change = r["ops_per_sec"] / base["ops_per_sec"] - 1
+        r["change"] = change
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark LightDHT hot paths")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS),
+                        help="only run these benchmark groups")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="routing table sizes, comma separated")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds to spend per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    # The code under test logs at INFO level on hot paths
+    logging.getLogger("lightdht").addHandler(logging.NullHandler())
+    logging.getLogger("krpcserver").addHandler(logging.NullHandler())
+
+    rng = random.Random(args.seed)
+    results = {}
+    for name in args.only or sorted(BENCHMARKS):
+        results.update(BENCHMARKS[name](args, rng))
+
+    output = {"python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results}
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        output["regressions"] = regressions
+        if regressions:
+            status = 1
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    print(json.dumps(output, indent=2, sort_keys=True))
+    sys.exit(status)
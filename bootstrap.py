@@ -0,0 +1,139 @@
+"""
+    Joining the DHT through a list of well known seed nodes.
+"""
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 6881
+
+DEFAULT_SEEDS = [
+    ("router.bittorrent.com", 6881),
+]
+
+
+def parse_seed(seed):
+    """
+        Turn "host", "host:port" or (host, port) into (host, port)
+    """
+    if isinstance(seed, (tuple, list)):
+        return seed[0], int(seed[1])
+    seed = seed.strip()
+    if seed.startswith("["):
+        # [IPv6 address]:port
+        host, _, port = seed[1:].partition("]")
+        return host, int(port.lstrip(":") or DEFAULT_PORT)
+    if seed.count(":") == 1:
+        host, port = seed.split(":")
+        return host, int(port)
+    return seed, DEFAULT_PORT
+
+
+def load_nodes_file(path):
+    """
+        Read seeds from a file with one "host port" or "host:port" per
+        line. Empty lines and lines starting with # are skipped.
+    """
+    seeds = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) == 2:
+                seeds.append((parts[0], int(parts[1])))
+            else:
+                seeds.append(parse_seed(parts[0]))
+    return seeds
+
+
+class Bootstrapper(object):
+    """
+        Resolves and pings a list of seed nodes in parallel, adding every
+        node that answers to the routing table.
+
+        run() returns as soon as quorum seed nodes answered, all seeds
+        have been tried, or timeout seconds passed, whichever comes first.
+        Seeds that are still resolving or waiting for a reply carry on in
+        the background and are added when they answer.
+    """
+    def __init__(self, server, rt, node_factory, id_, seeds,
+                 quorum=1, timeout=10.0, attempts=3, retry_delay=3.0,
+                 family=socket.AF_INET):
+        self._server = server
+        self._rt = rt
+        self._node_factory = node_factory
+        self._id = id_
+        self.seeds = [parse_seed(s) for s in seeds]
+        self.quorum = quorum
+        self.timeout = timeout
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.family = family
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._pending = 0
+        # connect_info of every seed that answered
+        self.responded = set()
+
+    def run(self):
+        """
+            Start joining all seeds, wait for a quorum and return the
+            number of seeds that answered so far.
+        """
+        if not self.seeds:
+            return 0
+        with self._lock:
+            self._pending = len(self.seeds)
+        for seed in self.seeds:
+            t = threading.Thread(target=self._join_seed, args=(seed,))
+            t.daemon = True
+            t.start()
+        self._done.wait(self.timeout)
+        return len(self.responded)
+
+    def _join_seed(self, seed):
+        try:
+            host, port = seed
+            try:
+                infos = socket.getaddrinfo(host, port, self.family, socket.SOCK_DGRAM)
+            except socket.gaierror as e:
+                logger.warning("Could not resolve bootstrap node {0}: {1}".format(host, e))
+                return
+            addrs = sorted(set(info[4][:2] for info in infos))
+            for attempt in range(self.attempts):
+                waiting = [c for c in addrs if c not in self.responded]
+                if not waiting:
+                    break
+                for c in waiting:
+                    self._ping(c)
+                time.sleep(self.retry_delay)
+        except Exception:
+            logger.exception("Exception while bootstrapping from {0}".format(seed))
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._done.set()
+
+    def _ping(self, c):
+        node = self._node_factory(c)
+        q = {"y": "q", "q": "ping", "a": {"id": self._id}}
+        try:
+            self._server.send_krpc(q, node, callback=self._on_reply)
+        except socket.error as e:
+            logger.warning("Could not ping bootstrap node {0}: {1}".format(c, e))
+
+    def _on_reply(self, rec, node):
+        node_id = rec["r"]["id"]
+        logger.info("Adding bootstrap node: IP: {0}, NodeID: {1}".format(node, node_id))
+        self._rt.update_entry(node_id, node)
+        with self._lock:
+            self.responded.add(node.c)
+            if len(self.responded) >= self.quorum:
+                self._done.set()
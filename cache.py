@@ -0,0 +1,199 @@
+"""
+    Caches used by the DHT to avoid redoing routing table work for
+    targets it has seen recently.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+        A size bounded mapping that evicts the least recently used entry.
+
+        Keeps hit and miss counters so callers can see whether the cache
+        is actually paying for itself.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+class EncodedNodesCache(LRUCache):
+    """
+        Cache of encoded compact node info, as sent in the "nodes" key of
+        find_node and get_peers replies.
+
+        Entries are keyed by the first prefix_bytes of the target, so
+        targets sharing that prefix are served the same reply. Each entry
+        remembers the routing table version it was computed against
+        (see RoutingTable.version) and is recomputed once that changes.
+    """
+    def __init__(self, rt, encode, prefix_bytes=2, max_entries=4096):
+        LRUCache.__init__(self, max_entries)
+        self._rt = rt
+        self._encode = encode
+        self.prefix_bytes = prefix_bytes
+
+    def get_encoded(self, target):
+        """
+            Return the encoded close nodes for target, from the cache if
+            the routing table has not changed underneath the entry.
+        """
+        key = target[:self.prefix_bytes]
+        version = self._rt.version(target)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Take the version before computing, so a concurrent table update
+        # makes the entry look stale rather than fresh.
+        encoded = self._encode(self._rt.get_close_nodes(target))
+        self.put(key, (version, encoded))
+        return encoded
+
+
+class TTLCache(LRUCache):
+    """
+        LRU cache whose entries also expire ttl seconds after being put.
+    """
+    def __init__(self, ttl, max_entries=4096, clock=time.time):
+        LRUCache.__init__(self, max_entries)
+        self.ttl = ttl
+        self._clock = clock
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        LRUCache.put(self, key, (self._clock() + self.ttl, value))
+
+
+def _distance(a, b):
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+
+class LookupCache(object):
+    """
+        Results of recent recursive lookups.
+
+        Keeps the peer values found for each info_hash, and the K closest
+        nodes that responded during a lookup for each target, so a repeat
+        lookup can return straight away or start close to the target
+        instead of from the routing table.
+
+        The closest nodes are also kept per target prefix of prefix_bytes,
+        so a lookup for a nearby target can start from them too.
+    """
+    def __init__(self, values_ttl=300.0, nodes_ttl=300.0, K=8,
+                 max_entries=4096, clock=time.time, prefix_bytes=2):
+        self.K = K
+        self.prefix_bytes = prefix_bytes
+        self._values = TTLCache(values_ttl, max_entries, clock)
+        self._closest = TTLCache(nodes_ttl, max_entries, clock)
+        # target prefix -> closest nodes of the latest lookup with it
+        self._nearby = TTLCache(nodes_ttl, max_entries, clock)
+
+    def get_values(self, info_hash):
+        return self._values.get(info_hash)
+
+    def put_values(self, info_hash, values):
+        self._values.put(info_hash, values)
+
+    def get_closest(self, target):
+        """
+            Return the cached [(node_id, node), ...] closest to target,
+            closest first, or None.
+        """
+        return self._closest.get(target)
+
+    def get_nearby(self, target):
+        """
+            Like get_closest(), but falls back to the nodes found for the
+            latest target sharing the first prefix_bytes with target,
+            re-sorted by distance to target. None if there are neither.
+        """
+        closest = self._closest.get(target)
+        if closest:
+            return closest
+        nearby = self._nearby.get(target[:self.prefix_bytes])
+        if not nearby:
+            return None
+        return sorted(nearby, key=lambda x: _distance(x[0], target))
+
+    def put_closest(self, target, nodes):
+        """
+            Remember the K nodes of [(node_id, node), ...] closest to target
+        """
+        seen = {}
+        for node_id, node in nodes:
+            seen[node_id] = node
+        closest = sorted(seen.items(), key=lambda x: _distance(x[0], target))
+        if closest:
+            self._closest.put(target, closest[:self.K])
+            self._nearby.put(target[:self.prefix_bytes], closest[:self.K])
+
+    def clear(self):
+        self._values.clear()
+        self._closest.clear()
+        self._nearby.clear()
+
+    def stats(self):
+        return {"values": self._values.stats(),
+                "closest": self._closest.stats(),
+                "nearby": self._nearby.stats()}
@@ -0,0 +1,259 @@
+"""
+    Harvesting info_hashes from the DHT with BEP0051 sample_infohashes.
+
+    Usage:
+
+        dht = lightdht.DHT(...)
+        dht.start()
+        crawler = Crawler(dht, packets_per_second=200)
+        for info_hash in crawler.crawl():
+            ...
+"""
+import collections
+import hashlib
+import heapq
+import logging
+import math
+import os
+import queue
+import time
+
+from lightdht import Node, decode_nodes, decode_nodes6, decode_samples
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+        Compact set membership test for info_hashes.
+
+        May report an item as seen when it was not (with probability
+        error_rate once capacity items were added), but never the other
+        way around.
+    """
+    def __init__(self, capacity=10000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._nbits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self._nhashes = max(1, int(round(self._nbits / float(capacity) * math.log(2))))
+        self._bits = bytearray((self._nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64 bit hashes
+        h = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "big")
+        h2 = int.from_bytes(h[8:], "big") | 1
+        nbits = self._nbits
+        return [(h1 + i * h2) % nbits for i in range(self._nhashes)]
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """
+            Add key, return True if it was not in the filter yet
+        """
+        bits = self._bits
+        new = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+class Crawler(object):
+    """
+        Crawls the DHT with sample_infohashes queries and yields every
+        info_hash it has not seen before.
+
+        Nodes to visit are kept in a frontier ordered by the time they
+        may be queried again; a node that answers is revisited once the
+        "interval" it sent has passed (but not before min_interval).
+        Nodes found in replies are added to the frontier and to the DHT's
+        routing table.
+
+        Every node queried is remembered, up to max_visited of them, and
+        is not queried again before its interval has passed, however
+        often it shows up in replies. Nodes that do not answer, or answer
+        without samples, wait min_interval.
+
+        No more than packets_per_second queries are sent, with bursts of
+        at most burst queries. That rate must leave the KRPC server's
+        transaction IDs enough time to expire.
+
+        Replies are not trusted: malformed ones are counted in
+        stats["bad_replies"] and otherwise ignored. Our own address and
+        node IDs are never visited.
+    """
+    def __init__(self, dht, packets_per_second=100, burst=None, max_frontier=100000,
+                 min_interval=60, seen=None, max_visited=1000000):
+        self._dht = dht
+        self._server = dht._server
+        transactions = self._server._transactions
+        if packets_per_second * transactions.timeout > transactions.size:
+            raise ValueError("At {0} packets per second, the {1} transaction IDs would run out "
+                             "before they expire after {2} seconds".format(
+                                 packets_per_second, transactions.size, transactions.timeout))
+        self.packets_per_second = packets_per_second
+        self.burst = burst or packets_per_second
+        self.max_frontier = max_frontier
+        self.min_interval = min_interval
+        self.max_visited = max_visited
+        self.seen = seen if seen is not None else BloomFilter()
+
+        # (due time, sequence number, node_id, connect_info)
+        self._frontier = []
+        self._scheduled = set()
+        self._seq = 0
+        # connect_info -> earliest time it may be queried again, oldest first
+        self._visited = collections.OrderedDict()
+        # Replies, handed over from the KRPC server thread
+        self._replies = queue.Queue()
+
+        # Addresses other nodes may list us under, see crawl()
+        self._own = set()
+
+        self.stats = {"sent": 0, "replies": 0, "bad_replies": 0, "samples": 0, "new": 0}
+
+    def add_node(self, node_id, c, due=0):
+        """
+            Schedule the node at connect_info c to be visited at time due
+        """
+        if c in self._scheduled or len(self._frontier) >= self.max_frontier:
+            return
+        if self._visited.get(c, 0) > due:
+            return
+        if c in self._own or node_id in self._dht._identities[0]:
+            return
+        self._scheduled.add(c)
+        self._seq += 1
+        heapq.heappush(self._frontier, (due, self._seq, node_id, c))
+
+    def _refill(self):
+        # Nothing left to visit: start again from the routing table
+        try:
+            for node_id, node in self._dht._rt.get_close_nodes(os.urandom(20)):
+                self.add_node(node_id, node.c)
+        except (IndexError, RuntimeError):
+            # Empty routing table
+            pass
+
+    def _visit(self, c, until):
+        visited = self._visited
+        visited[c] = until
+        visited.move_to_end(c)
+        if len(visited) > self.max_visited:
+            visited.popitem(last=False)
+
+    def _send(self, node_id, c):
+        node = Node(c)
+        q = {"y": "q", "q": "sample_infohashes",
+             "a": {"id": self._dht._get_id(node_id), "target": os.urandom(20)}}
+        if self._server.want:
+            q["a"]["want"] = self._server.want
+        self._server.send_krpc(q, node, callback=self._on_reply)
+        self.stats["sent"] += 1
+
+    def _on_reply(self, rec, node):
+        self._replies.put((rec, node))
+
+    def _own_addresses(self):
+        # Our public address is unknown, but there our node ID gives us
+        # away. This catches the local ones.
+        try:
+            host, port = self._server._transport.getsockname()[:2]
+        except (AttributeError, OSError):
+            return set()
+        return set((h, port) for h in ("127.0.0.1", "::1", host))
+
+    def _process(self, rec, node, now):
+        """
+            Handle a reply, return the info_hashes in it we had not seen
+        """
+        self.stats["replies"] += 1
+        try:
+            return self._parse(rec, node, now)
+        except Exception as e:
+            self.stats["bad_replies"] += 1
+            logger.debug("Bad reply from {0}: {1!r}".format(node.c, e))
+            return []
+
+    def _parse(self, rec, node, now):
+        new = []
+        r = rec.get("r", {})
+        node_id = r.get("id")
+        if node_id is not None:
+            self._dht._rt.update_entry(node_id, node)
+        for key, decode in (("nodes", decode_nodes), ("nodes6", decode_nodes6)):
+            if key == "nodes6" and not self._dht.ipv6:
+                continue
+            if key in r:
+                for new_id, new_c in decode(r[key]):
+                    self._dht._rt.update_entry(new_id, Node(new_c))
+                    self.add_node(new_id, new_c, now)
+        if "samples" in r and node_id is not None:
+            # Only nodes speaking BEP0051 are worth visiting again
+            interval = r.get("interval", 0)
+            if not isinstance(interval, int):
+                interval = 0
+            due = now + max(interval, self.min_interval)
+            self._visit(node.c, due)
+            self.add_node(node_id, node.c, due)
+            for info_hash in decode_samples(r["samples"]):
+                self.stats["samples"] += 1
+                if self.seen.add(info_hash):
+                    self.stats["new"] += 1
+                    new.append(info_hash)
+        return new
+
+    def crawl(self, duration=None):
+        """
+            Generator yielding new info_hashes as they are found.
+            Runs for duration seconds, or forever.
+        """
+        start = last = time.time()
+        budget = float(self.burst)
+        self._own = self._own_addresses()
+        while duration is None or time.time() - start < duration:
+            now = time.time()
+            budget = min(self.burst, budget + (now - last) * self.packets_per_second)
+            last = now
+
+            if not self._frontier:
+                self._refill()
+            while budget >= 1 and self._frontier and self._frontier[0][0] <= now:
+                due, _, node_id, c = heapq.heappop(self._frontier)
+                self._scheduled.discard(c)
+                # Until it answers with an interval of its own
+                self._visit(c, now + self.min_interval)
+                try:
+                    self._send(node_id, c)
+                except OSError as e:
+                    logger.warning("Could not send to {0}: {1}".format(c, e))
+                except IndexError:
+                    # Transaction table full, this node waits min_interval
+                    logger.warning("Out of transaction IDs, could not send to {0}".format(c))
+                    break
+                budget -= 1
+
+            # Wait for replies, but not longer than it takes for the
+            # next packet to become available.
+            try:
+                rec, node = self._replies.get(timeout=1.0 / self.packets_per_second)
+            except queue.Empty:
+                continue
+            for info_hash in self._process(rec, node, now):
+                yield info_hash
+            while True:
+                try:
+                    rec, node = self._replies.get_nowait()
+                except queue.Empty:
+                    break
+                for info_hash in self._process(rec, node, now):
+                    yield info_hash
@@ -1,17 +1,23 @@
 import threading
 import socket
-import time
-import struct
 import logging
 import traceback
 
 from bencode import bencode, bdecode, BTFailure
+from metrics import NULL_METRICS
+from tracing import Hooks
+from transport import UDPTransport
+from transactions import TransactionTable
 
 # Logging is disabled by default.
 # See http://docs.python.org/library/logging.html
 logger = logging.getLogger(__name__)
 #logger.addHandler(logging.NullHandler())
 
+# Queries counted by name in the metrics, anything else is "other"
+_QUERY_COUNTERS = dict((q, "packets_in." + q.decode()) for q in
+                       (b"ping", b"find_node", b"get_peers", b"announce_peer", b"sample_infohashes"))
+
 class KRPCError(Exception):
     pass
 
@@ -24,17 +30,22 @@ class KRPCTimeout(KRPCError):
 
 class KRPCServer(object):
 
-    def __init__(self, port, version):
+    def __init__(self, port, version, transport=None):
         self._port = port
         self._version = version
         self._shutdown_flag = False
         self._thread = None
-        self._sock = None
-        self._transaction_id = 0
-        self._transactions = {}
-        self._transactions_lock = threading.Lock()
-        self._results = {}
+        # Where packets come from and go to; real UDP unless told otherwise
+        self._transport = transport if transport is not None else UDPTransport()
+        self.time = self._transport.time
+        # Outstanding queries, by transaction ID
+        self._transactions = TransactionTable()
         self.handler = self.default_handler
+        self.metrics = NULL_METRICS
+        self.hooks = Hooks()
+        # Address families to ask for in find_node, get_peers and
+        # sample_infohashes queries, e.g. ["n4", "n6"] (BEP0032)
+        self.want = None
 
     def default_handler(self, req, c):
         """
@@ -48,9 +59,7 @@ class KRPCServer(object):
         """
             Start the KRPC server
         """
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock.settimeout(0.5)
-        self._sock.bind( ("0.0.0.0",self._port) )
+        self._transport.start(self._port)
         self._thread = threading.Thread(target=self._pump)
         self._thread.daemon = True
         self._thread.start()
@@ -61,6 +70,7 @@ class KRPCServer(object):
         """
         self._shutdown_flag = True
         self._thread.join()
+        self._transport.close()
 
     def _pump(self):
         """
@@ -70,92 +80,130 @@ class KRPCServer(object):
         while True:
             if self._shutdown_flag:
                 break
-            rec = {}
             try:
-                rec,c = self._sock.recvfrom(4096)
-                logger.debug("Received data from %r", c)
-                rec = bdecode(rec)
-                if rec["y"] == b"r":
-                    # It's a reply.
-                    # Remove the transaction id from the list of pending
-                    # transactions and add the result to the result table.
-                    # The client thread will take it from there.
-                    t = rec["t"]
-                    with self._transactions_lock:
-                        if t in self._transactions:
-                            node = self._transactions[t][1]
-                            node.trep = time.time()
-                            if t in node.t:
-                                node.t.remove(t)
-                            if self._transactions[t][0] is not None:
-                                self._transactions[t][0](rec, node) # invoke the callback
-                            else:
-                                self._results[t] = rec # sync path
-                            del self._transactions[t]
-                elif rec["y"] == b"q":
-                    # It's a request, send it to the handler.
-                    self.handler(rec,c)
-                elif rec["y"] == b"e":
-                    # just post the error to the results array,  but only if
-                    # we have a transaction ID!
-                    # Some software (e.g. LibTorrent) does not post the "t"
-                    if "t" in rec:
-                        t = rec["t"]
-                        with self._transactions_lock:
-                            if t in self._transactions:
-                                del self._transactions[t]
-                            self._results[t] = rec
+                data,c = self._transport.recvfrom(4096)
+            except socket.timeout:
+                # no packets, that's ok
+                continue
+            except OSError as E:
+                # Log and carry on to keep the packet pump alive.
+                logger.critical("Exception while receiving KRPC packets: " + str(E))
+                continue
+            self._handle_datagram(data, c)
+
+    def _handle_datagram(self, data, c):
+        """
+            Process a single incoming datagram
+        """
+        rec = {}
+        try:
+            logger.debug("Received data from %r", c)
+            metrics = self.metrics
+            metrics.inc("packets_in")
+            hooks = self.hooks
+            if hooks:
+                hooks.enter("decode")
+                try:
+                    rec = bdecode(data)
+                finally:
+                    hooks.exit("decode")
+            else:
+                rec = bdecode(data)
+            if rec["y"] == b"r":
+                # It's a reply.
+                # Either invoke the transaction's callback, or leave the
+                # result in the transaction for the waiting client thread
+                # to pick up.
+                t = rec["t"]
+                metrics.inc("packets_in.reply")
+                tr = self._transactions.match(t, c)
+                if tr is not None:
+                    node = tr.node
+                    node.trep = self.time()
+                    metrics.observe("query_rtt", node.trep - tr.sent)
+                    if tr.callback is not None:
+                        self._transactions.release(t, tr)
+                        tr.callback(rec, node) # invoke the callback
                     else:
-                        # log it
-                        logger.warning("Node %r reported error %r, but did "
-                                       "not specify a 't'" % (c,rec))
+                        tr.result = rec # sync path
+            elif rec["y"] == b"q":
+                # It's a request, send it to the handler.
+                if metrics.enabled:
+                    metrics.inc(_QUERY_COUNTERS.get(rec["q"], "packets_in.other"))
+                if hooks:
+                    hooks.enter("dispatch", rec["q"])
+                    try:
+                        self.handler(rec,c)
+                    finally:
+                        hooks.exit("dispatch", rec["q"])
                 else:
-                    raise RuntimeError("Unknown KRPC message %r from %r" % (rec,c))
-
-                # Scrub the transaction list
-                t1 = time.time()
-                for tid,(cb,node) in list(self._transactions.items()):
-                    if t1-node.treq > 10.0:
-                        with self._transactions_lock:
-                            if tid in self._transactions:
-                                del self._transactions[tid]
+                    self.handler(rec,c)
+            elif rec["y"] == b"e":
+                # just post the error to the transaction,  but only if
+                # we have a transaction ID!
+                # Some software (e.g. LibTorrent) does not post the "t"
+                metrics.inc("packets_in.error")
+                if "t" in rec:
+                    t = rec["t"]
+                    tr = self._transactions.match(t, c)
+                    if tr is not None:
+                        if tr.callback is not None:
+                            self._transactions.release(t, tr)
+                        else:
+                            tr.result = rec
+                else:
+                    # log it
+                    logger.warning("Node %r reported error %r, but did "
+                                   "not specify a 't'" % (c,rec))
+            else:
+                raise RuntimeError("Unknown KRPC message %r from %r" % (rec,c))
 
+            # Scrub the transaction list
+            expired = self._transactions.expire(self.time())
+            if expired:
+                metrics.inc("timeouts", expired)
 
-            except socket.timeout:
-                # no packets, that's ok
-                pass
-            except BTFailure:
-                # bdecode error, ignore the packet
-                pass
-            except Exception as E:
-                # Log and carry on to keep the packet pump alive.
-                #logger.critical("Exception while handling KRPC requests:\n\n"+traceback.format_exc()+("\n\n%r from %r" % (rec,c)))
-                logger.critical("Exception while handling KRPC requests:\n\n" +\
-                                 str(E) +\
-                                 "\n\n{request} from {peer}".format(request=rec, peer=c) )
+        except BTFailure:
+            # bdecode error, ignore the packet
+            self.metrics.inc("decode_failures")
+        except Exception as E:
+            # Log and carry on to keep the packet pump alive.
+            #logger.critical("Exception while handling KRPC requests:\n\n"+traceback.format_exc()+("\n\n%r from %r" % (rec,c)))
+            logger.critical("Exception while handling KRPC requests:\n\n" +\
+                             str(E) +\
+                             "\n\n{request} from {peer}".format(request=rec, peer=c) )
 
     def send_krpc(self, req , node, callback=None):
         """
             Perform a KRPC request
+
+            A request that already carries a "t" is sent as is, and its
+            reply is not tracked.
+
+            If sending fails, the transaction ID is freed again and the
+            error is raised.
         """
         #print("In send_krpc.")
         logger.debug("KRPC request to %r", node.c)
-        t = -1
+        node.treq = self.time()
+        tr = None
         if "t" not in req:
             # add transaction id
-            with self._transactions_lock:
-                self._transaction_id += 1
-                t = struct.pack("i",self._transaction_id)
+            t = self._transactions.add(callback, node, node.treq)
+            tr = self._transactions.get(t)
             req["t"] = t
         else:
             t = req["t"]
         req["v"] = self._version
-        data = bencode(req)
-        self._transactions[t] = callback, node
-        node.treq = time.time()
-        node.t.add(t)
-
-        self._sock.sendto(data, node.c)
+        try:
+            data = bencode(req)
+            self._transport.sendto(data, node.c)
+        except Exception:
+            if tr is not None:
+                self._transactions.release(t, tr)
+            raise
+        if self.metrics.enabled:
+            self.metrics.inc("packets_out." + req["q"])
         #print("Sent",data,"to",node.c)
         #print("Leaving send_krpc.")
         return t
@@ -168,7 +216,8 @@ class KRPCServer(object):
         logger.info("REPLY: %r %r" % (connect_info, resp))
 
         data = bencode(resp)
-        self._sock.sendto(data,connect_info)
+        self._transport.sendto(data,connect_info)
+        self.metrics.inc("packets_out.reply")
         #print("Sent",data,"to",connect_info)
         #print("Leaving send_krpc_reply")
 
@@ -180,20 +229,25 @@ class KRPCServer(object):
         # We fake a syncronous transaction by sending
         # the request, then waiting for the server thread
         # to post the results of our transaction into
-        # the results dict.
+        # the transaction table.
         #print("In _synctrans")
         t = self.send_krpc(q, node)
-        sent_t = time.time()
-        while t not in self._results:
-            time.sleep(1)
-            #print("Current delta-time:",abs(sent_t - time.time()))
-            if abs(sent_t - time.time()) > 10:
-                raise KRPCTimeout("Peer "+str(node)+" timed out after 5 seconds.")
+        tr = self._transactions.get(t)
+        sent_t = self.time()
+        try:
+            while tr.result is None:
+                self._transport.sleep(1)
+                #print("Current delta-time:",abs(sent_t - self.time()))
+                if abs(sent_t - self.time()) > 10:
+                    self.metrics.inc("timeouts")
+                    raise KRPCTimeout("Peer "+str(node)+" timed out after 10 seconds.")
+        finally:
+            self._transactions.release(t, tr)
 
         # Retrieve the result
-        r = self._results.pop(t)
+        r = tr.result
 
-        if r["y"]==r"e":
+        if r["y"]==b"e":
             # Error condition!
             raise KRPCError("Error {0} while processing transaction {1}".format(r,q))
 
@@ -207,10 +261,21 @@ class KRPCServer(object):
 
     def find_node(self, id_, node, target):
         q = { "y":"q", "q":"find_node", "a":{"id":id_,"target":target}}
+        if self.want:
+            q["a"]["want"] = self.want
         return self._synctrans(q, node)
 
     def get_peers(self, id_,node, info_hash):
         q = { "y":"q", "q":"get_peers", "a":{"id":id_,"info_hash":info_hash}}
+        if self.want:
+            q["a"]["want"] = self.want
+        return self._synctrans(q, node)
+
+    def sample_infohashes(self, id_, node, target):
+        # BEP0051
+        q = { "y":"q", "q":"sample_infohashes", "a":{"id":id_,"target":target}}
+        if self.want:
+            q["a"]["want"] = self.want
         return self._synctrans(q, node)
 
     def announce_peer(self, id_,node, info_hash, port, token):
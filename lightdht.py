@@ -13,19 +13,24 @@ Read README.md for more information.
 """
 
 import socket
-import os
 import time
 import hashlib
-import hmac
 import struct
 import threading
 import traceback
 import logging
 import random
-from binhex import binascii
+import binascii
 
 from krpcserver import KRPCServer, KRPCTimeout, KRPCError
-from routingtable import PrefixRoutingTable
+from routingtable import PrefixRoutingTable, DualStackRoutingTable
+from cache import EncodedNodesCache, LookupCache
+from peerstore import PeerStore
+from tokens import TokenManager
+from bootstrap import Bootstrapper, DEFAULT_SEEDS, load_nodes_file
+from metrics import Metrics, NULL_METRICS
+from transport import UDPTransport, is_ipv6
+from tracing import distance
 
 # See http://docs.python.org/library/logging.html
 logger = logging.getLogger(__name__)
@@ -71,12 +76,45 @@ def encode_nodes(nodes):
     return struct.pack("!" + "20sIH" * len(nodes), *n)
 
 
+def decode_nodes6(nodes):
+    """ Decode IPv6 node_info ("nodes6", BEP0032) into a list of id, connect_info """
+    for i in range(0, len(nodes) - len(nodes) % 38, 38):
+        id_, ip, port = struct.unpack("!20s16sH", nodes[i:i + 38])
+        yield id_, (socket.inet_ntop(socket.AF_INET6, ip), port)
+
+
+def encode_nodes6(nodes):
+    """ Encode a list of (id, connect_info) pairs with IPv6 addresses into "nodes6" """
+    return b"".join(struct.pack("!20s16sH", node[0], socket.inet_pton(socket.AF_INET6, node[1].c[0]),
+                                node[1].c[1])
+                    for node in nodes)
+
+
+def decode_samples(samples):
+    """ Split the "samples" of a sample_infohashes reply into info_hashes """
+    return [samples[i:i + 20] for i in range(0, len(samples) - len(samples) % 20, 20)]
+
+
+def encode_samples(info_hashes):
+    """ Encode a list of info_hashes into "samples" (BEP0051) """
+    return b"".join(info_hashes)
+
+
+def compact_peer(c):
+    """
+        Encode connect_info (ip, port) into 6 byte compact peer info, or
+        18 bytes for an IPv6 address
+    """
+    if is_ipv6(c[0]):
+        return socket.inet_pton(socket.AF_INET6, c[0]) + struct.pack("!H", c[1])
+    return struct.pack("!IH", dottedQuadToNum(c[0]), c[1])
+
+
 class Node(object):
     def __init__(self, c):
         self.c = c
         self.treq = 0
         self.trep = 0
-        self.t = set()
     def __repr__(self):
         return "Node({})".format(self.c)
     __str__ = __repr__
@@ -85,12 +123,43 @@ class NotFoundError(RuntimeError):
     pass
 
 class DHT(object):
-    def __init__(self, port, id_, version):
+    def __init__(self, port, id_, version, transport=None, ipv6=False):
         self._id = id_
+        # All node IDs we present to the network, the primary one first,
+        # and the same as integers. See add_identity().
+        self._identities = ([id_], [int.from_bytes(id_, "big")])
+        self._ids_lock = threading.Lock()
         self._version = version
-        self._server = KRPCServer(port, self._version)
-
-        self._rt = PrefixRoutingTable()
+        # With ipv6 set we also speak the DHT over IPv6 (BEP0032), keeping
+        # IPv6 nodes in a routing table of their own.
+        self.ipv6 = ipv6
+        if ipv6 and transport is None:
+            transport = UDPTransport(ipv6=True)
+        self._server = KRPCServer(port, self._version, transport)
+        # Clock of the transport, which may be virtual (see simulator.py)
+        self._time = self._server.time
+
+        rt4 = PrefixRoutingTable()
+        # Encoded "nodes" replies for recently queried target prefixes
+        self._nodes_cache = EncodedNodesCache(rt4, encode_nodes)
+        if ipv6:
+            rt6 = PrefixRoutingTable()
+            self._rt = DualStackRoutingTable(rt4, rt6)
+            self._nodes6_cache = EncodedNodesCache(rt6, encode_nodes6)
+            self._server.want = ["n4", "n6"]
+        else:
+            self._rt = rt4
+            self._nodes6_cache = None
+        self._plain_rt = self._rt
+        # Results of our own recent lookups
+        self._lookup_cache = LookupCache(clock=self._time)
+        # Peers announced to us
+        self._peers = PeerStore(clock=self._time)
+
+        # Runtime metrics, see enable_metrics()
+        self.metrics = NULL_METRICS
+        # Profiling hooks, shared with the KRPC server. See add_hook()
+        self.hooks = self._server.hooks
 
         # Thread details
         self._shutdown_flag = False
@@ -106,15 +175,119 @@ class DHT(object):
         self.self_find_delay = 180.0
         #   How many active node discovery attempts between self-lookups?
         self.active_discoveries = 10
-
-        # Session key
-        self._key = os.urandom(20) # 20 random bytes == 160 bits
+        #   Seed nodes to join the DHT through: (host, port) or "host:port"
+        self.bootstrap_nodes = list(DEFAULT_SEEDS)
+        #   Optional file with more seed nodes, one "host port" per line
+        self.bootstrap_nodes_file = None
+        #   How many seed nodes have to answer before start() returns
+        self.bootstrap_quorum = 1
+        #   How long start() waits for that at most, in seconds
+        self.bootstrap_timeout = 10.0
+        #   How many seconds a sample_infohashes reply stays the same
+        self.sample_interval = 300
+        #   And how many info_hashes it holds at most
+        self.sample_size = 20
+        self._sample = (0, b"")
+
+        # Announce tokens, with a secret that rotates every few minutes
+        self._tokens = TokenManager(clock=self._time)
 
         #print("Finished __init__.")
 
     def _get_id(self, target):
-        # Retrieve ID to use to communicate with target node
-        return self._id
+        # Retrieve ID to use to communicate with target node:
+        # the identity closest to it.
+        ids, nums = self._identities
+        if len(ids) == 1:
+            return ids[0]
+        t = int.from_bytes(target, "big")
+        best = min(range(len(nums)), key=lambda i: nums[i] ^ t)
+        return ids[best]
+
+    def add_identity(self, id_):
+        """
+            Add another node ID for this DHT node to present.
+
+            All identities share our socket and routing table. Queries we
+            send use the identity closest to the node we talk to, replies
+            use the one closest to the queried target, so each identity
+            ends up in the routing tables of nodes around it. The
+            maintenance thread looks up every identity, so the routing
+            table holds a close node view for each of them.
+
+            Note that all identities answer on the same address, so nodes
+            that see more than one of them may consider us inconsistent.
+        """
+        with self._ids_lock:
+            ids, nums = self._identities
+            if id_ in ids:
+                return
+            # Replace both at once rather than mutate, _get_id reads them
+            # unlocked
+            self._identities = (ids + [id_], nums + [int.from_bytes(id_, "big")])
+
+    def spread_identities(self, count):
+        """
+            Add count identities spread evenly across the keyspace
+        """
+        span = (1 << 160) // count
+        for i in range(count):
+            n = i * span + random.randrange(span)
+            self.add_identity(n.to_bytes(20, "big"))
+
+    def identities(self):
+        return list(self._identities[0])
+
+    def identity_view(self, id_):
+        """
+            The closest nodes we know of for one of our identities
+        """
+        closest = self._lookup_cache.get_closest(id_)
+        if closest:
+            return closest
+        return self._rt.get_close_nodes(id_)
+
+    def cache_stats(self):
+        """
+            Hit/miss statistics of the DHT's internal caches
+        """
+        stats = {"close_nodes": self._nodes_cache.stats(),
+                 "lookups": self._lookup_cache.stats()}
+        if self._nodes6_cache is not None:
+            stats["close_nodes6"] = self._nodes6_cache.stats()
+        return stats
+
+    def enable_metrics(self, metrics=None):
+        """
+            Start collecting runtime metrics, for this node and its KRPC
+            server, into metrics (a new Metrics registry by default).
+            Returns the registry.
+        """
+        if metrics is None:
+            metrics = Metrics()
+        server = self._server
+        metrics.gauge("transactions", lambda: len(server._transactions))
+        metrics.gauge("routing_table_nodes", lambda: self._rt.node_count())
+        metrics.gauge("routing_table_buckets", lambda: self._rt.bucket_sizes())
+        if self._nodes6_cache is not None:
+            metrics.gauge("routing_table6_nodes", lambda: self._nodes6_cache._rt.node_count())
+        metrics.gauge("peer_store_info_hashes", lambda: len(self._peers))
+        self.metrics = metrics
+        server.metrics = metrics
+        return metrics
+
+    def add_hook(self, point, enter=None, exit=None):
+        """
+            Call enter(point, name) and exit(point, name) around the
+            "decode", "dispatch" or "routing" step. See tracing.Hooks.
+        """
+        self.hooks.add(point, enter, exit)
+        if point == "routing" and self._rt is self._plain_rt:
+            # Route all routing table calls through the hooks from now on
+            self._rt = self.hooks.instrument(self._plain_rt)
+            self._nodes_cache._rt = self.hooks.instrument(self._nodes_cache._rt)
+            if self._nodes6_cache is not None:
+                self._nodes6_cache._rt = self.hooks.instrument(self._nodes6_cache._rt)
 
     def start(self):
         """
@@ -123,26 +296,25 @@ class DHT(object):
         #print("In start.")
         self._server.start()
         self._server.handler = self.handler
-
-        # Add the default nodes
-        # socket.gethostbyaddr returns (hostname, aliaslist, ipaddrlist)
-        # So, this uses the first alternate ip address of router.bittorrent.com
-        # according to DNS resolution.
-        AltIPs = socket.gethostbyaddr("router.bittorrent.com")[2]
-#        DEFAULT_CONNECT_INFO = (random.choice(AltIPs), 6881)
-#        # Default_Node is assigned a tuple of (ip, port)
-#        DEFAULT_NODE = Node(DEFAULT_CONNECT_INFO)
-#        DEFAULT_ID = self._server.ping(os.urandom(20), DEFAULT_NODE)['id']
-#        self._rt.update_entry(DEFAULT_ID, DEFAULT_NODE)
-        # Prior behaviour was to pick one of the router's alt-ips, this adds
-        # all of them..
-        for ip in AltIPs:
-            Connect_Info = (ip, 6881)
-            # Default_Node is assigned a tuple of (ip, port)
-            IP_Node = Node(Connect_Info)
-            IP_ID = self._server.ping(os.urandom(20), IP_Node)['id']
-            logger.info("Adding bootstrap alt-ip from router.bittorrent.com: IP: {0}, NodeID: {1}".format(IP_Node, IP_ID))
-            self._rt.update_entry(IP_ID, IP_Node)
+        if self.ipv6 and not getattr(self._server._transport, "ipv6", False):
+            # No IPv6 socket after all. Carry on over IPv4, the IPv6
+            # routing table simply stays empty.
+            logger.warning("IPv6 not available, running on IPv4 only")
+            self.ipv6 = False
+            self._server.want = None
+
+        # Join the DHT through the seed nodes. This returns once enough of
+        # them answered; the rest are added in the background.
+        seeds = list(self.bootstrap_nodes)
+        if self.bootstrap_nodes_file:
+            seeds.extend(load_nodes_file(self.bootstrap_nodes_file))
+        self._bootstrapper = Bootstrapper(self._server, self._rt, Node, self._id, seeds,
+                                          quorum=self.bootstrap_quorum,
+                                          timeout=self.bootstrap_timeout,
+                                          family=socket.AF_UNSPEC if self.ipv6 else socket.AF_INET)
+        responded = self._bootstrapper.run()
+        logger.info("{0} bootstrap nodes answered, routing table contains {1} nodes".format(
+            responded, self._rt.node_count()))
 
         # Start our event thread
         self._thread = threading.Thread(target=self._pump)
@@ -191,9 +363,18 @@ class DHT(object):
         if self.active_discovery:
             delay //= (self.active_discoveries + 1)
 
+        # Then around each of our other identities
+        for id_ in self._identities[0][1:]:
+            try:
+                self.find_node(id_, use_cache=False)
+            except:
+                logger.error("Exception while looking up identity {0}:\n\n".format(
+                    binascii.hexlify(id_).decode()) + traceback.format_exc())
+
         logger.info("Finished establishing connections to DHT, beginning maintenance.")
 
         iteration = 0
+        maintenance = 0
         while True:
             try:
                 time.sleep(delay)
@@ -203,17 +384,22 @@ class DHT(object):
                     self.find_node(target)
                     logger.info("Tracing done, routing table contains %d nodes", self._rt.node_count())
                 else:
-                    # Regular maintenance:
+                    # Regular maintenance, for each identity in turn:
+                    #  Look up the identity, to keep its close nodes fresh.
                     #  Find N random nodes. Execute a find_node() on them.
                     #  toss them if they come up empty.
-                    n = self._rt.sample(self._id, 10, 1)
+                    ids = self._identities[0]
+                    id_ = ids[maintenance % len(ids)]
+                    maintenance += 1
+                    if len(ids) > 1:
+                        self.find_node(id_, use_cache=False)
+                    n = self._rt.sample(id_, 10, 1)
                     for node_id, c in n:
                         try:
                             #print("In _pump: calling self._server.find_node()")
-                            r = self._server.find_node(self._id, c, self._id)
+                            r = self._server.find_node(id_, c, id_)
                             #print("In _pump: finished self._server.find_node()")
-                            if "nodes" in r:
-                                self._process_incoming_nodes(r["nodes"])
+                            self._process_incoming_nodes(r)
                         except KRPCTimeout:
                             # The node did not reply.
                             # Blacklist it.
@@ -224,17 +410,37 @@ class DHT(object):
                 # the exception and carry on.
                 logger.critical("Exception in DHT maintenance thread:\n\n" + traceback.format_exc())
 
-    def _process_incoming_nodes(self, bnodes):
-        # Add them to the routing table
-        for node_id, node_c in decode_nodes(bnodes):
-            self._rt.update_entry(node_id, Node(node_c))
-
-    def _recurse(self, target, function, max_attempts=10, result_key=None):
+    def _process_incoming_nodes(self, r):
+        # Add the "nodes" (and "nodes6") of reply r to the routing table
+        ids = []
+        if "nodes" in r:
+            for node_id, node_c in decode_nodes(r["nodes"]):
+                self._rt.update_entry(node_id, Node(node_c))
+                ids.append(node_id)
+        if "nodes6" in r and self.ipv6:
+            for node_id, node_c in decode_nodes6(r["nodes6"]):
+                self._rt.update_entry(node_id, Node(node_c))
+                ids.append(node_id)
+        return ids
+
+    def _recurse(self, target, function, max_attempts=10, result_key=None, use_cache=True, trace=None):
         """
             Recursively query the DHT, following "nodes" replies
             until we hit the desired key
 
             This is the workhorse function used by all recursive queries.
+
+            If use_cache is set and a recent lookup for the same target,
+            or a nearby one (see LookupCache.get_nearby), left a set of
+            closest nodes behind, we start from those rather than from the
+            routing table. The nodes that answered us are
+            remembered for the next lookup either way.
+
+            If trace is a tracing.LookupTrace, every query made is
+            recorded in it.
+
+            With IPv6 enabled, the close nodes of both routing tables are
+            queried, so the lookup proceeds through both address families.
         """
         #print("In _recurse.")
         if isinstance(target, bytes):
@@ -242,66 +448,164 @@ class DHT(object):
         else:
             target_hex = target
         logger.debug("Recursing to target {0}".format(target))
-        attempts = 0
-        while attempts < max_attempts:
-            close_nodes = self._rt.get_close_nodes(target)
-            if not close_nodes:
-                raise NotFoundError("No close nodes found with self.rt.get_close_nodes for "+str(target)+\
-                                    " Current routing table: "+str(self._rt._nodes))
-            for id_, node in close_nodes:
-                try:
-                    #print("Calling function", function, "in _recurse.")
-                    r = function(self._get_id(id_), node, target)
-                    #print("Finished calling function in _recurse.")
-                    logger.debug("Recursion results from %r ", node.c)
-                    attempts += 1
-                    if result_key and result_key in r:
-                        return r[result_key]
-                    if "nodes" in r:
-                        self._process_incoming_nodes(r["nodes"])
-                except KRPCTimeout:
-                    # The node did not reply.
-                    # Blacklist it.
-                    if self._rt.node_count() > 8:
-                        logger.error("Node timed out: blacklisting {0}".format(node.c))
-                        self._rt.bad_node(id_, node)
-                    else:
-                        logger.error("Node timed out: Would blacklist, but only 8 nodes known. Node: {0}".format(node.c))
-                    continue
-                except KRPCError:
-                    # Sometimes we just flake out due to UDP being unreliable
-                    # Don't sweat it, just log and carry on.
-                    logger.error("KRPC Error:\n\n" + traceback.format_exc())
-
-        if result_key:
-            # We were expecting a result, but we did not find it!
-            # Raise the NotFoundError exception instead of returning None
-            raise NotFoundError
+        started = self._time()
+        if trace is not None:
+            trace.start(target)
+        # How the lookup ended, for the trace: "error" unless it gets
+        # to one of the other outcomes
+        result = "error"
+        try:
+            attempts = 0
+            responders = []
+            # Replies that got us closer to the target than any before,
+            # see LookupTrace.routing_hops. Only counted for the metrics.
+            hops = 0
+            best = None
+            start_nodes = self._lookup_cache.get_nearby(target) if use_cache else None
+            while attempts < max_attempts:
+                if start_nodes:
+                    close_nodes, start_nodes = start_nodes, None
+                else:
+                    close_nodes = self._rt.get_close_nodes(target)
+                if not close_nodes:
+                    raise NotFoundError("No close nodes found with self.rt.get_close_nodes for "+str(target)+\
+                                        " Routing table size: "+str(self._rt.node_count()))
+                for id_, node in close_nodes:
+                    hop = trace.hop(id_, node.c) if trace is not None else None
+                    try:
+                        #print("Calling function", function, "in _recurse.")
+                        r = function(self._get_id(id_), node, target)
+                        #print("Finished calling function in _recurse.")
+                        logger.debug("Recursion results from %r ", node.c)
+                        attempts += 1
+                        responders.append((id_, node))
+                        if self.metrics.enabled:
+                            d = distance(id_, target)
+                            if best is None or d < best:
+                                best = d
+                                hops += 1
+                        if result_key and result_key in r:
+                            if hop:
+                                trace.done(hop, "reply")
+                            result = "found"
+                            self._lookup_cache.put_closest(target, responders)
+                            self._lookup_done(started, hops, attempts)
+                            return r[result_key]
+                        new_nodes = self._process_incoming_nodes(r)
+                        if hop:
+                            trace.done(hop, "reply", new_nodes)
+                    except KRPCTimeout:
+                        attempts += 1
+                        if hop:
+                            trace.done(hop, "timeout")
+                        # The node did not reply.
+                        # Blacklist it.
+                        if self._rt.node_count() > 8:
+                            logger.error("Node timed out: blacklisting {0}".format(node.c))
+                            self._rt.bad_node(id_, node)
+                        else:
+                            logger.error("Node timed out: Would blacklist, but only 8 nodes known. Node: {0}".format(node.c))
+                        continue
+                    except KRPCError:
+                        # Sometimes we just flake out due to UDP being unreliable
+                        # Don't sweat it, just log and carry on.
+                        attempts += 1
+                        if hop:
+                            trace.done(hop, "error")
+                        logger.error("KRPC Error:\n\n" + traceback.format_exc())
+
+            result = "exhausted"
+            self._lookup_cache.put_closest(target, responders)
+            self._lookup_done(started, hops, attempts)
+            if result_key:
+                # We were expecting a result, but we did not find it!
+                # Raise the NotFoundError exception instead of returning None
+                raise NotFoundError
+        finally:
+            if trace is not None:
+                trace.finish(result)
         #print("Finished _recurse.")
 
-    def find_node(self, target, attempts=10):
+    def _lookup_done(self, started, hops, queries):
+        metrics = self.metrics
+        if metrics.enabled:
+            metrics.inc("lookups")
+            metrics.observe("lookup_hops", hops, scale=1)
+            metrics.observe("lookup_queries", queries, scale=1)
+            metrics.observe("lookup_duration", self._time() - started)
+
+    def find_node(self, target, attempts=10, use_cache=True, trace=None):
         """
             Recursively call the find_node function to get as
             close as possible to the target node
+
+            If we traced to this target recently, there is nothing new to
+            learn and we return straight away. Pass use_cache=False to
+            force a fresh lookup.
+
+            Pass a tracing.LookupTrace as trace to have the lookup
+            recorded in it.
         """
         if isinstance(target, bytes):
             target_hex = binascii.hexlify(target).decode()
         else:
             target_hex = target
         logger.debug("Tracing to {0}".format(target_hex))
-        self._recurse(target, self._server.find_node, max_attempts=attempts)
-
-    def get_peers(self, info_hash, attempts=10):
+        if use_cache and self._lookup_cache.get_closest(target):
+            if trace is not None:
+                trace.start(target)
+                trace.finish("cached")
+            return
+        self._recurse(target, self._server.find_node, max_attempts=attempts,
+                      use_cache=use_cache, trace=trace)
+
+    def get_peers(self, info_hash, attempts=10, use_cache=True, trace=None):
         """
             Recursively call the get_peers function to fidn peers
             for the given info_hash
+
+            Peers found for the same info_hash within the last few
+            minutes are returned from the cache, unless use_cache=False.
+
+            Pass a tracing.LookupTrace as trace to have the lookup
+            recorded in it.
         """
         if isinstance(info_hash, bytes):
             info_hash_hex = binascii.hexlify(info_hash).decode()
         else:
             info_hash_hex = info_hash
         logger.debug("Finding peers for {0}".format(info_hash_hex))
-        return self._recurse(info_hash, self._server.get_peers, result_key="values", max_attempts=attempts)
+        if use_cache:
+            values = self._lookup_cache.get_values(info_hash)
+            if values:
+                if trace is not None:
+                    trace.start(info_hash)
+                    trace.finish("cached")
+                return values
+        values = self._recurse(info_hash, self._server.get_peers, result_key="values",
+                               max_attempts=attempts, use_cache=use_cache, trace=trace)
+        self._lookup_cache.put_values(info_hash, values)
+        return values
+
+    def _add_close_nodes(self, r, target, rec, c):
+        """
+            Add the nodes closest to target to reply r: "nodes", "nodes6"
+            or both, as the query's "want" asks for (BEP0032). Without a
+            "want", the querying node gets nodes of its own address family.
+            Families we know no nodes of are left out; if that leaves
+            nothing, "nodes" is sent empty.
+        """
+        want = rec["a"].get("want")
+        if not isinstance(want, list):
+            want = [b"n6" if is_ipv6(c[0]) else b"n4"]
+        cache6 = self._nodes6_cache if self.ipv6 else None
+        if b"n6" in want and cache6 is not None and cache6._rt.node_count():
+            r["nodes6"] = cache6.get_encoded(target)
+        if b"n4" in want or "nodes6" not in r:
+            if self._nodes_cache._rt.node_count():
+                r["nodes"] = self._nodes_cache.get_encoded(target)
+            elif "nodes6" not in r:
+                r["nodes"] = b""
 
     def default_handler(self, rec, c):
         """
@@ -318,34 +622,55 @@ class DHT(object):
         elif rec["q"] == b"find_node":
             target = rec["a"]["target"]
             resp["r"]["id"] = self._get_id(target)
-            resp["r"]["nodes"] = encode_nodes(self._rt.get_close_nodes(target))
+            self._add_close_nodes(resp["r"], target, rec, c)
             self._server.send_krpc_reply(resp, c)
         elif rec["q"] == b"get_peers":
             # Provide a token so we can receive announces
-            # The token is generated using HMAC and a secret
-            # session key, so we don't have to remember it.
-            # Token is based on nodes id, connection details
-            # torrent infohash to avoid clashes in NAT scenarios.
+            # The token is a keyed hash of the node's IP and a rotating
+            # secret, so we don't have to remember it.
             info_hash = rec["a"]["info_hash"]
             resp["r"]["id"] = self._get_id(info_hash)
-            token = hmac.new(self._key, info_hash + peer_id + str(c), hashlib.sha1).digest()
-            resp["r"]["token"] = token
-            # We don't actually keep any peer administration, so we
-            # always send back the closest nodes
-            resp["r"]["nodes"] = encode_nodes(self._rt.get_close_nodes(info_hash))
+            resp["r"]["token"] = self._tokens.token(c)
+            # Send back the peers we know of, or the closest nodes if
+            # nobody announced this info_hash to us. Peers are of the
+            # requester's address family only (BEP0032).
+            values = self._peers.get(info_hash, ipv6=is_ipv6(c[0]))
+            if values:
+                resp["r"]["values"] = values
+            else:
+                self._add_close_nodes(resp["r"], info_hash, rec, c)
             self._server.send_krpc_reply(resp, c)
         elif rec["q"] == b"announce_peer":
             # First things first, validate the token.
             info_hash = rec["a"]["info_hash"]
             resp["r"]["id"] = self._get_id(info_hash)
-            peer_id = rec["a"]["id"]
-            token = hmac.new(self._key, info_hash + peer_id + str(c), hashlib.sha1).digest()
-            if token != rec["a"]["token"]:
+            if not self._tokens.verify(rec["a"].get("token"), c):
                 return  # Ignore the request
             else:
-                # We don't actually keep any peer administration, so we
-                # just acknowledge.
+                # Store the peer. With implied_port set, the peer wants
+                # us to use the source port of the packet instead.
+                if rec["a"].get("implied_port"):
+                    port = c[1]
+                else:
+                    port = rec["a"]["port"]
+                self._peers.add(info_hash, compact_peer((c[0], port)))
                 self._server.send_krpc_reply(resp, c)
+        elif rec["q"] == b"sample_infohashes":
+            # BEP0051: a random sample of the info_hashes we hold peers for.
+            # The sample is only redrawn every sample_interval seconds.
+            target = rec["a"]["target"]
+            resp["r"]["id"] = self._get_id(target)
+            now = self._time()
+            expires, samples = self._sample
+            if expires <= now:
+                samples = encode_samples(self._peers.sample_info_hashes(self.sample_size))
+                self._sample = (now + self.sample_interval, samples)
+                expires = now + self.sample_interval
+            resp["r"]["samples"] = samples
+            resp["r"]["num"] = len(self._peers)
+            resp["r"]["interval"] = int(expires - now)
+            self._add_close_nodes(resp["r"], target, rec, c)
+            self._server.send_krpc_reply(resp, c)
         else:
             logger.error("Unknown request in query %r" % rec)
 
@@ -0,0 +1,208 @@
+"""
+    Runtime metrics: counters, gauges and latency histograms.
+
+    Metrics are off by default; KRPCServer and DHT report to NULL_METRICS,
+    whose methods do nothing. Turn them on with DHT.enable_metrics(), then
+    read them with Metrics.snapshot(), or serve them as text:
+
+        metrics = dht.enable_metrics()
+        serve_metrics(metrics, 9100)     # http://127.0.0.1:9100/metrics
+"""
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+_NAME_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class Histogram(object):
+    """
+        HDR style histogram: buckets are powers of two, each split into
+        2**sub_bucket_bits linear sub-buckets, so every recorded value is
+        kept with a fixed relative precision (1/16th with the default 4
+        bits) whatever its magnitude.
+
+        Values are multiplied by scale and truncated to integers before
+        being recorded, e.g. scale=1e6 records seconds as microseconds.
+    """
+    def __init__(self, scale=1, sub_bucket_bits=4):
+        self.scale = scale
+        self._bits = sub_bucket_bits
+        self._sub = 1 << sub_bucket_bits
+        self._counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, v):
+        if v < self._sub:
+            return v
+        shift = v.bit_length() - (self._bits + 1)
+        return (shift + 1) * self._sub + (v >> shift) - self._sub
+
+    def _lowest(self, index):
+        if index < self._sub:
+            return index
+        shift = index // self._sub - 1
+        return (index % self._sub + self._sub) << shift
+
+    def record(self, value):
+        v = max(0, int(value * self.scale))
+        i = self._index(v)
+        self._counts[i] = self._counts.get(i, 0) + 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        """ The value below which p percent of the recorded values fall """
+        if not self.count:
+            return 0
+        wanted = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i in sorted(self._counts):
+            seen += self._counts[i]
+            if seen >= wanted:
+                return min(self._lowest(i), self.max) / float(self.scale)
+        return self.max / float(self.scale)
+
+    def snapshot(self):
+        scale = float(self.scale)
+        return {"count": self.count,
+                "sum": self.total / scale,
+                "min": (self.min or 0) / scale,
+                "max": (self.max or 0) / scale,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Metrics(object):
+    """
+        Registry of named counters, gauges and histograms.
+
+        Gauges are callables, evaluated when a snapshot is taken. They may
+        return a number, or a dict of numbers for a labelled family.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value, scale=1e6):
+        """
+            Record value in histogram name. The histogram is created on
+            first use, with the given scale (microseconds by default).
+        """
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram(scale)
+            h.record(value)
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        """ All current values, as a dict """
+        with self._lock:
+            snap = {"counters": dict(self._counters),
+                    "histograms": dict((k, h.snapshot()) for k, h in self._histograms.items())}
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = repr(e)
+        snap["gauges"] = gauges
+        return snap
+
+    def exposition(self):
+        """ The snapshot in the Prometheus text format """
+        snap = self.snapshot()
+        lines = []
+        for name, value in sorted(snap["counters"].items()):
+            lines.append("{0} {1}".format(_metric_name(name), value))
+        for name, value in sorted(snap["gauges"].items()):
+            if isinstance(value, dict):
+                for label, v in sorted(value.items()):
+                    lines.append('{0}{{key="{1}"}} {2}'.format(_metric_name(name), _label_value(label), v))
+            elif isinstance(value, (int, float)):
+                lines.append("{0} {1}".format(_metric_name(name), value))
+        for name, h in sorted(snap["histograms"].items()):
+            name = _metric_name(name)
+            for q in ("p50", "p90", "p99"):
+                lines.append('{0}{{quantile="0.{1}"}} {2}'.format(name, q[1:], h[q]))
+            lines.append("{0}_count {1}".format(name, h["count"]))
+            lines.append("{0}_sum {1}".format(name, h["sum"]))
+        return "\n".join(lines) + "\n"
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _metric_name(name):
+    # Anything but [a-zA-Z0-9_] would break the exposition format
+    return "lightdht_" + _NAME_INVALID.sub("_", name)
+
+
+class NullMetrics(Metrics):
+    """
+        Stand-in used while metrics are disabled. Does nothing, cheaply.
+    """
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def inc(self, name, n=1):
+        pass
+
+    def observe(self, name, value, scale=1e6):
+        pass
+
+    def gauge(self, name, fn):
+        pass
+
+    def snapshot(self):
+        return {"counters": {}, "gauges": {}, "histograms": {}}
+
+
+NULL_METRICS = NullMetrics()
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+        Serve metrics.exposition() over HTTP from a background thread.
+        Returns the server; call shutdown() on it to stop.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.exposition().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
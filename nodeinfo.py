@@ -2,13 +2,15 @@
     Basic program to show the useage of lightdht.
     
     We run a dht node and log all incoming queries.
+    Read them back with observer.read_observations().
 """
 import logging
 import time
 import os
-from binhex import binascii
+import binascii
 
 import lightdht
+from observer import ObservationSink
 
 
 # Enable logging:
@@ -31,49 +33,38 @@ id_ = os.urandom(20)
 dht = lightdht.DHT(port=54768, id_=id_, version="XN\x00\x00") 
 
 # where to put our product
-outf = open("get-peers.{}.log".format(binascii.hexlify(id_).decode()), "a")
+sink = ObservationSink("queries.{}".format(binascii.hexlify(id_).decode()))
+sink.start()
 
-# handler
-def myhandler(rec, c):
-    try:    
-        if rec["y"] == b"q":
-            if rec["q"] == b"get_peers":
-                print(";".join(
-                    [   str(time.time()),
-                        binascii.hexlify(rec["a"].get("id")       ).decode(),
-                        binascii.hexlify(rec["a"].get("info_hash")).decode(),
-                        repr(c),
-                    ]), file=outf)
-                outf.flush()
-                        
-    finally:
-        # always ALWAYS pass it off to the real handler
-        dht.default_handler(rec,c) 
-
-dht.handler = myhandler
+# Record every query, then pass it off to the real handler
+dht.handler = sink.wrap(dht.default_handler)
 dht.active_discovery = False
 dht.self_find_delay = 30
 
 # Start it!
-with dht:
-    # Debian install DVD:
-    target_infohash = binascii.unhexlify("96534331d2d75acf14f8162770495bd5b05a17a9")
-    found_infohash = False
+try:
+    with dht:
+        # Debian install DVD:
+        target_infohash = binascii.unhexlify("96534331d2d75acf14f8162770495bd5b05a17a9")
+        found_infohash = False
 
-    # Go to sleep and let the DHT service requests.
-    elapsed = 0
-    while True:
-        time.sleep(1)
-        elapsed += 1
-        # Debian install iso: 96534331d2d75acf14f8162770495bd5b05a17a9
-        try:
-            # Give find_node two minutes to populate..
-            if elapsed < 120: continue
-            if not found_infohash:
-                dht.find_node(target_infohash)
-            torrent_peers = dht.get_peers(target_infohash)
-            if torrent_peers:
-                found_infohash = True
-                print("Got peers:\n", torrent_peers)
-        except:
-            pass
+        # Go to sleep and let the DHT service requests.
+        elapsed = 0
+        while True:
+            time.sleep(1)
+            elapsed += 1
+            # Debian install iso: 96534331d2d75acf14f8162770495bd5b05a17a9
+            try:
+                # Give find_node two minutes to populate..
+                if elapsed < 120: continue
+                if not found_infohash:
+                    dht.find_node(target_infohash)
+                torrent_peers = dht.get_peers(target_infohash)
+                if torrent_peers:
+                    found_infohash = True
+                    print("Got peers:\n", torrent_peers)
+            except:
+                pass
+finally:
+    # Write out what is still buffered
+    sink.shutdown()
@@ -0,0 +1,228 @@
+"""
+    Recording incoming DHT queries to disk, for later analysis.
+
+    Every query becomes a fixed size binary record:
+
+        timestamp   8 bytes, double, seconds since the epoch
+        node_id     20 bytes, the querying node's ID
+        info_hash   20 bytes, the info_hash or target queried, or zeroes
+        ip          16 bytes, IPv6 address (IPv4 is mapped to ::ffff:a.b.c.d)
+        port        2 bytes
+        query       1 byte, one of QUERY_TYPES
+
+    All in network byte order. Records are written by a background thread
+    in batches, to files that are rotated by size and age. Use
+    read_observations() to get them back.
+
+    Usage:
+
+        sink = ObservationSink("queries")
+        sink.start()
+        dht.handler = sink.wrap(dht.default_handler)
+"""
+import collections
+import glob
+import logging
+import mmap
+import socket
+import struct
+import threading
+import time
+
+from transport import is_ipv6
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("!d20s20s16sHB")
+
+QUERY_TYPES = {
+    b"ping": 1,
+    b"find_node": 2,
+    b"get_peers": 3,
+    b"announce_peer": 4,
+    b"sample_infohashes": 5,
+}
+QUERY_NAMES = dict((v, k) for k, v in QUERY_TYPES.items())
+QUERY_OTHER = 0
+
+_NO_HASH = b"\x00" * 20
+_V4_MAPPED = b"\x00" * 10 + b"\xff\xff"
+
+Observation = collections.namedtuple("Observation",
+                                     "time node_id info_hash ip port query")
+
+
+def _pack_ip(ip):
+    if is_ipv6(ip):
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return _V4_MAPPED + socket.inet_aton(ip)
+
+
+def _unpack_ip(packed):
+    if packed[:12] == _V4_MAPPED:
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def encode_observation(rec, c, now=None):
+    """ Pack an incoming KRPC query rec from connect_info c into a record """
+    a = rec.get("a", {})
+    q = rec.get("q")
+    target = a.get("info_hash") or a.get("target") or _NO_HASH
+    return RECORD.pack(time.time() if now is None else now,
+                       a.get("id", _NO_HASH), target,
+                       _pack_ip(c[0]), c[1], QUERY_TYPES.get(q, QUERY_OTHER))
+
+
+def decode_observation(data, offset=0):
+    t, node_id, info_hash, ip, port, query = RECORD.unpack_from(data, offset)
+    return Observation(t, node_id, info_hash, _unpack_ip(ip), port,
+                       QUERY_NAMES.get(query, query))
+
+
+def read_observations(path, use_mmap=False):
+    """
+        Generator yielding the Observations stored in the file at path.
+        A trailing partial record (from a file still being written) is
+        ignored.
+    """
+    size = RECORD.size
+    with open(path, "rb") as f:
+        if use_mmap:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return
+            try:
+                for offset in range(0, len(data) - size + 1, size):
+                    yield decode_observation(data, offset)
+            finally:
+                data.close()
+        else:
+            while True:
+                chunk = f.read(size * 4096)
+                end = len(chunk) - len(chunk) % size
+                for offset in range(0, end, size):
+                    yield decode_observation(chunk, offset)
+                if len(chunk) < size * 4096:
+                    break
+
+
+def observation_files(prefix):
+    """ The files written by an ObservationSink with this prefix, oldest first """
+    return sorted(glob.glob(prefix + ".*.obs"))
+
+
+class ObservationSink(object):
+    """
+        Buffers observation records in memory and writes them to disk from
+        a background thread.
+
+        Files are named <prefix>.<milliseconds since epoch>.obs, and a new
+        one is started when the current one grows beyond max_bytes or gets
+        older than max_age seconds.
+
+        If the writer falls behind by more than max_pending records, new
+        records are dropped (and counted in self.dropped) rather than
+        letting memory grow without bounds. Queries too malformed to
+        record are counted in self.malformed.
+    """
+    def __init__(self, prefix, max_bytes=64 * 1024 * 1024, max_age=3600,
+                 flush_interval=1.0, max_pending=1000000):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.malformed = 0
+        self.written = 0
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._shutdown_flag = False
+        self._thread = None
+        self._file = None
+        self._file_size = 0
+        self._file_opened = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._pump)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """ Write out everything still pending and close the file """
+        self._shutdown_flag = True
+        if self._thread is not None:
+            self._thread.join()
+        self._flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.shutdown()
+
+    def record(self, rec, c):
+        """ Queue an incoming KRPC query for writing """
+        data = encode_observation(rec, c)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(data)
+
+    def wrap(self, handler):
+        """
+            Return a KRPC request handler that records every query, then
+            passes it on to handler.
+        """
+        def observing_handler(rec, c):
+            try:
+                if rec.get("y") == b"q":
+                    self.record(rec, c)
+            except Exception:
+                # Count only, this runs for every packet
+                self.malformed += 1
+                logger.debug("Could not record query from {0}".format(c))
+            finally:
+                handler(rec, c)
+        return observing_handler
+
+    def _pump(self):
+        while not self._shutdown_flag:
+            time.sleep(self.flush_interval)
+            try:
+                self._flush()
+            except Exception:
+                logger.exception("Exception while writing observations")
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        now = time.time()
+        if (self._file is None or self._file_size >= self.max_bytes
+                or now - self._file_opened >= self.max_age):
+            self._rotate(now)
+        data = b"".join(pending)
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        self.written += len(pending)
+
+    def _rotate(self, now):
+        if self._file is not None:
+            self._file.close()
+        path = "{0}.{1}.obs".format(self.prefix, int(now * 1000))
+        logger.info("Writing observations to {0}".format(path))
+        self._file = open(path, "ab")
+        self._file_size = self._file.tell()
+        self._file_opened = now
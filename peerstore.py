@@ -0,0 +1,172 @@
+"""
+    Storage for peers announced to us through announce_peer.
+"""
+import collections
+import math
+import random
+import struct
+import threading
+import time
+
+# Expiry time of a peer entry, in whole seconds
+_EXPIRY = struct.Struct("!I")
+
+
+class PeerList(object):
+    """
+        The peers of one info_hash, packed into a bytearray per address
+        family: records of a 4 byte expiry time followed by the 6 (IPv4)
+        or 18 (IPv6) byte compact peer info, in announce order.
+    """
+    __slots__ = ["v4", "v6"]
+
+    def __init__(self):
+        self.v4 = bytearray()
+        self.v6 = None
+
+    def __len__(self):
+        n = len(self.v4) // 10
+        if self.v6:
+            n += len(self.v6) // 22
+        return n
+
+    def _records(self, peer):
+        if len(peer) == 6:
+            return self.v4
+        if self.v6 is None:
+            self.v6 = bytearray()
+        return self.v6
+
+    def add(self, peer, expires, max_peers):
+        """
+            Add peer, or move it to the back if we have it already.
+            Drops the oldest peer of its family beyond max_peers.
+        """
+        records = self._records(peer)
+        size = 4 + len(peer)
+        i = records.find(peer, 4)
+        while i != -1:
+            if i % size == 4:
+                del records[i - 4:i - 4 + size]
+                break
+            i = records.find(peer, i + 1)
+        records += _EXPIRY.pack(int(math.ceil(expires))) + peer
+        if len(records) > max_peers * size:
+            del records[:size]
+
+    def expire(self, now):
+        """ Drop the peers that expired before now """
+        for records, size in ((self.v4, 10), (self.v6, 22)):
+            if not records:
+                continue
+            i = 0
+            while i < len(records) and _EXPIRY.unpack_from(records, i)[0] < now:
+                i += size
+            if i:
+                del records[:i]
+
+    def newest(self):
+        """ Expiry time of the most recently announced peer, or 0 """
+        newest = 0
+        for records, size in ((self.v4, 10), (self.v6, 22)):
+            if records:
+                newest = max(newest, _EXPIRY.unpack_from(records, len(records) - size)[0])
+        return newest
+
+    def peers(self, ipv6=False):
+        """ All compact IPv4 peers, or all IPv6 ones """
+        if ipv6:
+            if not self.v6:
+                return []
+            return [bytes(self.v6[i + 4:i + 22]) for i in range(0, len(self.v6), 22)]
+        return [bytes(self.v4[i + 4:i + 10]) for i in range(0, len(self.v4), 10)]
+
+
+class PeerStore(object):
+    """
+        Keeps the compact peer info (6 bytes for IPv4: ip, port, 18 for
+        IPv6) announced for each info_hash, until it expires after ttl
+        seconds. Each peer takes 4 bytes on top of that, see PeerList.
+
+        Both the info_hashes and the peers per info_hash are kept in
+        announce order: re-announcing moves an entry to the back. Since all
+        entries live for the same ttl, the expired ones are always at the
+        front, so expiring them only ever looks at entries that are
+        actually removed, no matter how many announces we hold.
+    """
+    def __init__(self, ttl=30 * 60, max_hashes=100000, max_peers=1000, clock=time.time):
+        self.ttl = ttl
+        self.max_hashes = max_hashes
+        self.max_peers = max_peers
+        self._clock = clock
+        # info_hash -> PeerList
+        self._hashes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, info_hash):
+        return info_hash in self._hashes
+
+    def add(self, info_hash, peer):
+        """
+            Store compact peer info for info_hash.
+        """
+        now = self._clock()
+        with self._lock:
+            self._sweep(now)
+            peers = self._hashes.get(info_hash)
+            if peers is None:
+                if len(self._hashes) >= self.max_hashes:
+                    # Drop the info_hash that was announced least recently
+                    self._hashes.popitem(last=False)
+                peers = self._hashes[info_hash] = PeerList()
+            else:
+                self._hashes.move_to_end(info_hash)
+            peers.add(peer, now + self.ttl, self.max_peers)
+
+    def get(self, info_hash, N=50, ipv6=False):
+        """
+            Return up to N unexpired compact peers for info_hash, of IPv4
+            peers or, with ipv6 set, of IPv6 ones.
+        """
+        now = self._clock()
+        with self._lock:
+            peers = self._hashes.get(info_hash)
+            if peers is None:
+                return []
+            peers.expire(now)
+            if not peers:
+                del self._hashes[info_hash]
+                return []
+            peers = peers.peers(ipv6)
+        if len(peers) <= N:
+            return peers
+        return random.sample(peers, N)
+
+    def sample_info_hashes(self, N=20):
+        """
+            Return up to N random info_hashes we hold peers for.
+        """
+        with self._lock:
+            hashes = list(self._hashes)
+        if len(hashes) <= N:
+            return hashes
+        return random.sample(hashes, N)
+
+    def sweep(self):
+        """
+            Drop every info_hash that has not been announced within ttl
+        """
+        with self._lock:
+            self._sweep(self._clock())
+
+    def _sweep(self, now):
+        # Must be called with _lock held
+        hashes = self._hashes
+        while hashes:
+            info_hash, peers = next(iter(hashes.items()))
+            if peers.newest() >= now:
+                break
+            del hashes[info_hash]
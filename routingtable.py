@@ -1,8 +1,11 @@
+import binascii
 import collections
 import threading
 import random
 import time
 
+from transport import is_ipv6
+
 
 def strxor(a, b):
     """ xor two strings of different lengths """
@@ -33,6 +36,19 @@ class RoutingTable(object):
     def sample(self, id_, N, prefix_bytes=1):
         raise NotImplemented
 
+    def bucket_sizes(self):
+        """
+            Number of nodes per bucket, as {hex prefix: count}
+        """
+        raise NotImplemented
+
+    def version(self, target):
+        """
+            Return a token that changes whenever the result of
+            get_close_nodes(target) may have changed.
+        """
+        raise NotImplemented
+
 
 # This is our routing table.
 # We don't do any bucketing or anything like that, we just
@@ -45,10 +61,16 @@ class FlatRoutingTable(RoutingTable):
         self._nodes = {}
         self._nodes_lock = threading.Lock()
         self._bad = set()
+        # Bumped whenever a node is added, moved or removed. Refreshing a
+        # node we already know about does not change the close node sets.
+        self._generation = 0
 
     def update_entry(self, node_id, node):
         if node not in self._bad:
             with self._nodes_lock:
+                old = self._nodes.get(node_id)
+                if old is None or old.c != node.c:
+                    self._generation += 1
                 self._nodes[node_id] = node
 
     def get_close_nodes(self, target, N=3):
@@ -71,13 +93,14 @@ class FlatRoutingTable(RoutingTable):
         # and return the top N matches
         with self._nodes_lock:
             nodes = [(node_id, self._nodes[node_id]) for node_id in self._nodes]
-        nodes.sort(key=lambda x: strxor(target, x[0:1]))
+        nodes.sort(key=lambda x: strxor(target, x[0]))
         return nodes[:N]
 
     def remove_node(self, node_id):
         with self._nodes_lock:
             if node_id in self._nodes:
                 del self._nodes[node_id]
+                self._generation += 1
 
     def bad_node(self, node_id, node):
         self.remove_node(node_id)
@@ -86,6 +109,13 @@ class FlatRoutingTable(RoutingTable):
     def node_count(self):
         return len(self._nodes)
 
+    def version(self, target):
+        return self._generation
+
+    def bucket_sizes(self):
+        # One big bucket
+        return {"": len(self._nodes)}
+
     def sample(self, id_, N, prefix_bytes=1):
         with self._nodes_lock:
             nodes_to_select = [(k, v) for k, v in list(self._nodes.items()) if k[:prefix_bytes] == id_[:prefix_bytes]]
@@ -100,25 +130,72 @@ class PrefixRoutingTable(RoutingTable):
         self._nodes_lock = threading.Lock()
         self._bad = set()
         self._prefix_bytes = prefix_bytes
+        # Per-bucket versions, bumped when a bucket gains, moves or loses a
+        # node. _structure is bumped when a bucket becomes (non)empty, which
+        # changes which bucket get_close_nodes() picks for a target.
+        self._versions = collections.defaultdict(int)
+        self._structure = 0
+        # Memo of the closest non-empty bucket per leading target byte.
+        # Only valid for the current _structure.
+        self._closest_bucket = {}
+
+    def _structure_changed(self):
+        # Must be called with _nodes_lock held
+        self._structure += 1
+        self._closest_bucket.clear()
+
+    def _bucket_for(self, target):
+        # Must be called with _nodes_lock held
+        p = self._closest_bucket.get(target[0])
+        if p is None:
+            ordered_keys = sorted(self._nodes.keys(), key = lambda x: abs(x[0] ^ target[0]))
+            ordered_nonempty_keys = filter(lambda x:bool(self._nodes[x]), ordered_keys)
+            p = list(ordered_nonempty_keys)[0]
+            self._closest_bucket[target[0]] = p
+        return p
 
     def update_entry(self, node_id, node):
         if node not in self._bad:
+            p = node_id[:self._prefix_bytes]
             with self._nodes_lock:
-                self._nodes[node_id[:self._prefix_bytes]][node_id] = node
+                bucket = self._nodes[p]
+                old = bucket.get(node_id)
+                if old is None:
+                    if not bucket:
+                        self._structure_changed()
+                    self._versions[p] += 1
+                elif old.c != node.c:
+                    self._versions[p] += 1
+                bucket[node_id] = node
 
     def get_close_nodes(self, target, N=3):
         with self._nodes_lock:
-            ordered_keys = sorted(self._nodes.keys(), key = lambda x: abs(x[0] ^ target[0]))
-#            p = min(list(self._nodes.keys()), key = lambda x: abs(x[0] ^ target[0]))
-            ordered_nonempty_keys = filter(lambda x:bool(self._nodes[x]), ordered_keys)
-            p = list(ordered_nonempty_keys)[0]
+            p = self._bucket_for(target)
             ids = sorted(self._nodes[p], key=lambda x: strxor(x, target))[:8]
             return [(id_, self._nodes[p][id_]) for id_ in ids]
 
+    def version(self, target):
+        with self._nodes_lock:
+            try:
+                p = self._bucket_for(target)
+            except IndexError:
+                # Empty table
+                return (self._structure, None)
+            return (self._structure, self._versions[p])
+
+    def bucket_sizes(self):
+        with self._nodes_lock:
+            return dict((binascii.hexlify(p).decode(), len(b)) for p, b in self._nodes.items() if b)
+
     def remove_node(self, node_id):
+        p = node_id[:self._prefix_bytes]
         with self._nodes_lock:
-            if node_id in self._nodes[node_id[:self._prefix_bytes]]:
-                del self._nodes[node_id[:self._prefix_bytes]][node_id]
+            bucket = self._nodes.get(p)
+            if bucket and node_id in bucket:
+                del bucket[node_id]
+                self._versions[p] += 1
+                if not bucket:
+                    self._structure_changed()
 
     def bad_node(self, node_id, node):
         self.remove_node(node_id)
@@ -166,7 +243,12 @@ class PrefixRoutingTable(RoutingTable):
         return random.choice(nlist)
 
     def cleanup (self, timeout):
-        abandoned_transactions = []
+        """
+            Drop nodes with a request outstanding for longer than timeout.
+            Returns the dropped (node_id, node) pairs. Their transactions
+            expire from the KRPC server's transaction table by themselves.
+        """
+        abandoned_nodes = []
         for prefix in list(self._nodes.keys()):
             for k,v in list(self._nodes[prefix].items()):
                 # outstanding request and request older than timeout
@@ -174,8 +256,73 @@ class PrefixRoutingTable(RoutingTable):
                     # Node is bad
                     with self._nodes_lock:
                         if k in self._nodes[prefix]:
-                            for tid in self._nodes[prefix][k].t:
-                                abandoned_transactions.append(tid)
+                            abandoned_nodes.append((k, v))
                             del self._nodes[prefix][k]
+                            self._versions[prefix] += 1
+                            if not self._nodes[prefix]:
+                                self._structure_changed()
                         self._bad.add(v.c)
-        return abandoned_transactions
+        return abandoned_nodes
+
+
+class DualStackRoutingTable(RoutingTable):
+    """
+        Separate routing tables for IPv4 and IPv6 nodes, as BEP0032 asks
+        for, behind the interface of a single one.
+
+        Nodes go to the table of their address family. get_close_nodes()
+        merges the close nodes of both tables, so a lookup proceeds through
+        both families at once.
+    """
+    def __init__(self, rt4, rt6):
+        self._rt4 = rt4
+        self._rt6 = rt6
+
+    def table_for(self, node):
+        return self._rt6 if is_ipv6(node.c[0]) else self._rt4
+
+    def update_entry(self, node_id, node):
+        self.table_for(node).update_entry(node_id, node)
+
+    def get_close_nodes(self, target, N=3):
+        nodes = []
+        for rt in (self._rt4, self._rt6):
+            try:
+                nodes.extend(rt.get_close_nodes(target, N))
+            except (IndexError, RuntimeError):
+                # Empty table
+                pass
+        nodes.sort(key=lambda x: strxor(x[0], target))
+        return nodes
+
+    def remove_node(self, node_id):
+        self._rt4.remove_node(node_id)
+        self._rt6.remove_node(node_id)
+
+    def bad_node(self, node_id, node):
+        self.table_for(node).bad_node(node_id, node)
+
+    def node_count(self):
+        return self._rt4.node_count() + self._rt6.node_count()
+
+    def version(self, target):
+        return (self._rt4.version(target), self._rt6.version(target))
+
+    def bucket_sizes(self):
+        sizes = self._rt4.bucket_sizes()
+        for p, n in self._rt6.bucket_sizes().items():
+            sizes[p] = sizes.get(p, 0) + n
+        return sizes
+
+    def sample(self, id_, N, prefix_bytes=1):
+        nodes = []
+        for rt in (self._rt4, self._rt6):
+            try:
+                nodes.extend(rt.sample(id_, N, prefix_bytes))
+            except ValueError:
+                # Not enough nodes in this table
+                pass
+        return nodes
+
+    def cleanup(self, timeout):
+        return self._rt4.cleanup(timeout) + self._rt6.cleanup(timeout)
@@ -0,0 +1,379 @@
+"""
+    Deterministic in-process simulation of a DHT network, for
+    benchmarking lookups without touching the real network.
+
+    A SimNetwork holds any number of simulated nodes. They are cheap: a
+    node is an ID, and its routing contacts are only worked out when
+    something first talks to it. The node under test is a real DHT,
+    with its real routing table, talking KRPC to the simulated nodes
+    through a SimTransport that runs on a virtual clock. Latency, packet
+    loss and churn are drawn from a seeded random generator, so the same
+    seed gives the same numbers every run.
+
+    Usage:
+
+        python simulator.py --nodes 100000 --lookups 200 --seed 1
+
+    or:
+
+        net = SimNetwork(100000, seed=1, loss=0.05)
+        dht = net.make_dht()
+        print(net.run_lookups(dht, 200))
+"""
+import argparse
+import bisect
+import heapq
+import json
+import logging
+import math
+import random
+import socket
+import struct
+
+from bencode import bencode, bdecode, BTFailure
+from lightdht import DHT, Node, NotFoundError
+from tracing import LookupTrace
+
+ID_BITS = 160
+
+
+def lognormal_latency(median=0.05, sigma=0.5):
+    """ One-way latency distribution: log-normal around median seconds """
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class VirtualClock(object):
+    """
+        Virtual time, advanced by running scheduled events in order.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self._events = []
+        self._seq = 0
+
+    def time(self):
+        return self.now
+
+    def schedule(self, when, fn, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (when, self._seq, fn, args))
+
+    def run_until(self, until):
+        """
+            Run the events due up to until, but stop after the first
+            moment at which anything happened, so callers waiting on a
+            result get to look at it.
+        """
+        events = self._events
+        if not events or events[0][0] > until:
+            self.now = max(self.now, until)
+            return
+        when = events[0][0]
+        self.now = max(self.now, when)
+        while events and events[0][0] == when:
+            _, _, fn, args = heapq.heappop(events)
+            fn(*args)
+
+
+class SimTransport(object):
+    """
+        Transport (see transport.py) connecting a real KRPCServer to a
+        SimNetwork. There is no receive thread: incoming packets are
+        handed to deliver() while the server sleeps, which is when the
+        synchronous KRPC calls wait for their replies.
+    """
+    def __init__(self, network, c):
+        self._network = network
+        self.c = c
+        # Set by the network to the KRPCServer's packet handler
+        self.deliver = None
+        self.sent = 0
+
+    def start(self, port):
+        pass
+
+    def close(self):
+        pass
+
+    def recvfrom(self, bufsize):
+        raise socket.timeout()
+
+    def sendto(self, data, c):
+        self.sent += 1
+        self._network.send(self, data, c)
+
+    def time(self):
+        return self._network.clock.now
+
+    def sleep(self, seconds):
+        clock = self._network.clock
+        clock.run_until(clock.now + seconds)
+
+
+class SimNode(object):
+    __slots__ = ["index", "id", "contacts", "alive", "checked"]
+
+    def __init__(self, index, id_):
+        self.index = index
+        self.id = id_
+        self.contacts = None
+        self.alive = True
+        self.checked = 0.0
+
+
+class SimNetwork(object):
+    """
+        A network of num_nodes simulated DHT nodes.
+
+        latency     callable(rng) giving a one-way delay in seconds
+        loss        probability that any one packet is dropped
+        dead        fraction of nodes that never answer
+        churn_rate  rate (per virtual second) at which live nodes leave
+        K           bucket size of the simulated nodes, and the number of
+                    nodes closest to an info_hash that store its peers
+    """
+    BASE_IP = struct.unpack("!I", socket.inet_aton("10.0.0.0"))[0]
+    PORT = 6881
+
+    def __init__(self, num_nodes, seed=0, latency=None, loss=0.0, dead=0.0,
+                 churn_rate=0.0, K=8):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.latency = latency or lognormal_latency()
+        self.loss = loss
+        self.dead = dead
+        self.churn_rate = churn_rate
+        self.K = K
+        self.clock = VirtualClock()
+
+        self._ids = sorted(set(self.rng.getrandbits(ID_BITS) for _ in range(num_nodes)))
+        self._nodes = {}
+        self._transports = {}
+        self._holders = {}
+        self.messages = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    # Addressing: simulated node i lives at 10.0.0.0 + i + 1
+
+    def _address(self, index):
+        return (socket.inet_ntoa(struct.pack("!I", self.BASE_IP + index + 1)), self.PORT)
+
+    def _index(self, c):
+        try:
+            index = struct.unpack("!I", socket.inet_aton(c[0]))[0] - self.BASE_IP - 1
+        except (OSError, struct.error):
+            return None
+        if 0 <= index < len(self._ids) and c[1] == self.PORT:
+            return index
+        return None
+
+    def _node(self, index):
+        node = self._nodes.get(index)
+        if node is None:
+            node = self._nodes[index] = SimNode(index, self._ids[index])
+            node.alive = self._node_rng(index).random() >= self.dead
+            node.checked = self.clock.now
+        return node
+
+    def _node_rng(self, index):
+        return random.Random(self.seed * 1000003 + index)
+
+    def _range(self, prefix, bits):
+        # Indices of the nodes whose top bits of ID equal prefix
+        shift = ID_BITS - bits
+        lo = bisect.bisect_left(self._ids, prefix << shift)
+        hi = bisect.bisect_left(self._ids, (prefix + 1) << shift)
+        return lo, hi
+
+    def contacts_for(self, id_, rng, is_member=False):
+        """
+            Kademlia style routing contacts for a node with ID id_: up to
+            K random nodes from each subtree that shares exactly b leading
+            bits with id_, for every b that has any nodes. is_member says
+            whether id_ is one of the simulated nodes.
+        """
+        contacts = []
+        for b in range(ID_BITS):
+            prefix = (id_ >> (ID_BITS - b - 1)) ^ 1
+            lo, hi = self._range(prefix, b + 1)
+            if hi - lo <= self.K:
+                contacts.extend(range(lo, hi))
+            else:
+                contacts.extend(rng.sample(range(lo, hi), self.K))
+            # Stop once the subtree around id_ holds nothing but id_ itself
+            own_lo, own_hi = self._range(id_ >> (ID_BITS - b - 1), b + 1)
+            if own_hi - own_lo <= (1 if is_member else 0):
+                break
+        return contacts
+
+    def closest(self, target, N):
+        """ Indices of the N nodes closest to target """
+        bits = ID_BITS
+        while bits > 0:
+            lo, hi = self._range(target >> (ID_BITS - bits), bits)
+            if hi - lo >= N:
+                break
+            bits -= 1
+        else:
+            lo, hi = 0, len(self._ids)
+        return sorted(range(lo, hi), key=lambda i: self._ids[i] ^ target)[:N]
+
+    def holds_peers(self, index, info_hash):
+        holders = self._holders.get(info_hash)
+        if holders is None:
+            holders = self._holders[info_hash] = frozenset(
+                self.closest(int.from_bytes(info_hash, "big"), self.K))
+        return index in holders
+
+    def _is_alive(self, node):
+        if node.alive and self.churn_rate:
+            elapsed = self.clock.now - node.checked
+            if elapsed > 0 and self.rng.random() < 1 - math.exp(-self.churn_rate * elapsed):
+                node.alive = False
+        node.checked = self.clock.now
+        return node.alive
+
+    def _pack_nodes(self, indices):
+        return b"".join(struct.pack("!20s4sH", self._ids[i].to_bytes(20, "big"),
+                                    socket.inet_aton(self._address(i)[0]), self.PORT)
+                        for i in indices)
+
+    # Packets
+
+    def make_dht(self, port=6881, id_=None, version=b"SM\x00\x00", contacts=None):
+        """
+            Create a real DHT attached to this network, with its routing
+            table filled like that of a node that has been around a
+            while (or with contacts, a list of simulated node indices).
+        """
+        if id_ is None:
+            id_ = self.rng.getrandbits(ID_BITS).to_bytes(20, "big")
+        c = ("192.168.0.%d" % (len(self._transports) + 1), port)
+        transport = SimTransport(self, c)
+        dht = DHT(port, id_, version, transport=transport)
+        transport.deliver = dht._server._handle_datagram
+        self._transports[c] = transport
+        if contacts is None:
+            contacts = self.contacts_for(int.from_bytes(id_, "big"), random.Random(self.seed))
+        for i in contacts:
+            dht._rt.update_entry(self._ids[i].to_bytes(20, "big"), Node(self._address(i)))
+        return dht
+
+    def send(self, transport, data, c):
+        self.messages += 1
+        if self.rng.random() < self.loss:
+            return
+        index = self._index(c)
+        if index is None:
+            return
+        delay = self.latency(self.rng)
+        self.clock.schedule(self.clock.now + delay, self._receive, transport, index, data)
+
+    def _receive(self, transport, index, data):
+        node = self._node(index)
+        if not self._is_alive(node):
+            return
+        reply = self._answer(node, data)
+        if reply is None:
+            return
+        self.messages += 1
+        if self.rng.random() < self.loss:
+            return
+        delay = self.latency(self.rng)
+        self.clock.schedule(self.clock.now + delay, transport.deliver,
+                            reply, self._address(index))
+
+    def _answer(self, node, data):
+        try:
+            rec = bdecode(data)
+        except BTFailure:
+            return None
+        if rec.get("y") != b"q":
+            return None
+        q = rec.get("q")
+        a = rec.get("a", {})
+        r = {"id": node.id.to_bytes(20, "big")}
+        if q == b"find_node" or q == b"get_peers":
+            if node.contacts is None:
+                node.contacts = self.contacts_for(node.id, self._node_rng(node.index), True)
+            target = a.get("target") or a.get("info_hash")
+            if q == b"get_peers":
+                r["token"] = b"simtoken"
+                if self.holds_peers(node.index, target):
+                    r["values"] = [struct.pack("!4sH", socket.inet_aton(self._address(node.index)[0]), 6881)]
+                    return bencode({"y": "r", "t": rec["t"], "r": r})
+            t = int.from_bytes(target, "big")
+            closest = sorted(node.contacts, key=lambda i: self._ids[i] ^ t)[:self.K]
+            r["nodes"] = self._pack_nodes(closest)
+        elif q != b"ping":
+            return bencode({"y": "e", "t": rec["t"], "e": [204, "Method Unknown"]})
+        return bencode({"y": "r", "t": rec["t"], "r": r})
+
+    # Benchmarking
+
+    def run_lookups(self, dht, count, attempts=20):
+        """
+            Run count get_peers lookups for random info_hashes, and return
+            statistics on hops, messages and latency per lookup.
+        """
+        transport = dht._server._transport
+        results = []
+        for _ in range(count):
+            info_hash = self.rng.getrandbits(ID_BITS).to_bytes(20, "big")
+            trace = LookupTrace(clock=self.clock.time)
+            sent = transport.sent
+            started = self.clock.now
+            try:
+                dht.get_peers(info_hash, attempts=attempts, use_cache=False, trace=trace)
+                found = True
+            except (NotFoundError, IndexError, RuntimeError):
+                found = False
+            results.append({"found": found,
+                            "hops": trace.routing_hops,
+                            "messages": transport.sent - sent,
+                            "latency": self.clock.now - started})
+        return summarize(results)
+
+
+def _stats(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def pct(p):
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return {"mean": sum(values) / float(len(values)), "p50": pct(50),
+            "p90": pct(90), "p99": pct(99), "max": values[-1]}
+
+
+def summarize(results):
+    return {"lookups": len(results),
+            "success_rate": sum(1 for r in results if r["found"]) / float(len(results) or 1),
+            "hops": _stats([r["hops"] for r in results]),
+            "messages": _stats([r["messages"] for r in results]),
+            "latency": _stats([r["latency"] for r in results])}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DHT lookups on a simulated network")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="median one-way latency, seconds")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--dead", type=float, default=0.0)
+    parser.add_argument("--churn-rate", type=float, default=0.0)
+    parser.add_argument("--attempts", type=int, default=20)
+    args = parser.parse_args()
+
+    # Timeouts are expected here; keep the DHT's error log quiet
+    logging.getLogger("lightdht").addHandler(logging.NullHandler())
+
+    net = SimNetwork(args.nodes, seed=args.seed, latency=lognormal_latency(args.latency),
+                     loss=args.loss, dead=args.dead, churn_rate=args.churn_rate)
+    dht = net.make_dht()
+    summary = net.run_lookups(dht, args.lookups, attempts=args.attempts)
+    summary["config"] = vars(args)
+    print(json.dumps(summary, indent=2, sort_keys=True))
@@ -0,0 +1,57 @@
+"""
+    Joining through local stand-in seed nodes.
+
+        python -m unittest test_bootstrap
+"""
+import logging
+import os
+import socket
+import time
+import unittest
+
+from lightdht import DHT
+
+logging.getLogger("lightdht").addHandler(logging.NullHandler())
+logging.getLogger("krpcserver").addHandler(logging.NullHandler())
+
+
+def unused_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class BootstrapTest(unittest.TestCase):
+    def setUp(self):
+        # A seed node that answers, with nothing to bootstrap from itself
+        self.seed = DHT(0, os.urandom(20), b"SD\x00\x00")
+        self.seed._server.start()
+        self.seed._server.handler = self.seed.handler
+        self.seed_c = ("127.0.0.1", self.seed._server._transport.getsockname()[1])
+
+    def tearDown(self):
+        self.seed._server.shutdown()
+
+    def test_quorum_returns_without_waiting_for_dead_seeds(self):
+        dht = DHT(0, os.urandom(20), b"TS\x00\x00")
+        dht.active_discovery = False
+        dht.bootstrap_nodes = ["127.0.0.1:{0}".format(self.seed_c[1]),
+                               ("127.0.0.1", unused_port())]
+        dht.bootstrap_quorum = 1
+        dht.bootstrap_timeout = 5.0
+        started = time.time()
+        dht.start()
+        try:
+            elapsed = time.time() - started
+            self.assertLess(elapsed, 2.0)
+            self.assertEqual(dht._bootstrapper.responded, set([self.seed_c]))
+            self.assertEqual(dict(dht._rt.get_close_nodes(self.seed._id))[self.seed._id].c,
+                             self.seed_c)
+        finally:
+            dht.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+    Tokens handed out in get_peers replies and checked on announce_peer.
+"""
+import hashlib
+import hmac
+import os
+import socket
+import threading
+import time
+
+from transport import is_ipv6
+
+def compact_ip(ip):
+    """ Packed binary form of an IPv4 or IPv6 address string """
+    if is_ipv6(ip):
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return socket.inet_aton(ip)
+
+
+class TokenManager(object):
+    """
+        Generates and verifies announce tokens as described in BEP 5.
+
+        A token is a keyed hash of the querying node's IP address. The
+        secret key rotates every rotate_interval seconds and tokens made
+        with the previous secret are still accepted, so a token is valid
+        for between one and two intervals.
+
+        The keyed hash state for each secret is set up once at rotation
+        time; generating a token only copies it and feeds in the IP.
+    """
+    def __init__(self, rotate_interval=5 * 60, token_size=8, clock=time.time):
+        self.rotate_interval = rotate_interval
+        self.token_size = token_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._current = self._new_state()
+        self._previous = self._new_state()
+        self._next_rotation = self._clock() + self.rotate_interval
+
+    def _new_state(self):
+        return hashlib.blake2b(key=os.urandom(32), digest_size=self.token_size)
+
+    def _maybe_rotate(self):
+        now = self._clock()
+        if now < self._next_rotation:
+            return
+        with self._lock:
+            if now < self._next_rotation:
+                return
+            if now - self._next_rotation >= self.rotate_interval:
+                # We missed a whole interval, the previous secret is
+                # too old to be honoured as well.
+                self._previous = self._new_state()
+            else:
+                self._previous = self._current
+            self._current = self._new_state()
+            self._next_rotation = now + self.rotate_interval
+
+    def rotate(self):
+        """ Force a rotation of the secret """
+        with self._lock:
+            self._previous = self._current
+            self._current = self._new_state()
+            self._next_rotation = self._clock() + self.rotate_interval
+
+    @staticmethod
+    def _digest(state, ip):
+        h = state.copy()
+        h.update(ip)
+        return h.digest()
+
+    def token(self, c):
+        """ Token for the node at connect_info c """
+        self._maybe_rotate()
+        return self._digest(self._current, compact_ip(c[0]))
+
+    def verify(self, token, c):
+        """ Check, in constant time, a token presented by the node at c """
+        if not isinstance(token, bytes):
+            return False
+        self._maybe_rotate()
+        ip = compact_ip(c[0])
+        current, previous = self._current, self._previous
+        # Evaluate both, so timing does not reveal which secret matched
+        ok_current = hmac.compare_digest(token, self._digest(current, ip))
+        ok_previous = hmac.compare_digest(token, self._digest(previous, ip))
+        return ok_current or ok_previous
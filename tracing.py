@@ -0,0 +1,210 @@
+"""
+    Tracing of recursive lookups, and hooks for profiling the packet path.
+
+    To see where a lookup spends its time, pass a LookupTrace:
+
+        trace = LookupTrace()
+        dht.get_peers(info_hash, trace=trace)
+        print(trace.summary())
+        for hop in trace.hops:
+            print(hop)
+
+    To profile only the hot path, attach hooks:
+
+        profiler = cProfile.Profile()
+        dht.add_hook("dispatch", lambda point, name: profiler.enable(),
+                                 lambda point, name: profiler.disable())
+"""
+import time
+
+
+def distance(a, b):
+    """ XOR distance between two IDs, as an integer """
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+
+class Hop(object):
+    """
+        A single query made during a lookup.
+
+        outcome is "reply", "timeout" or "error"; nodes holds the IDs of
+        the nodes the reply pointed us to.
+    """
+    __slots__ = ["node_id", "c", "sent", "received", "distance", "outcome", "nodes"]
+
+    def __init__(self, node_id, c, sent, distance):
+        self.node_id = node_id
+        self.c = c
+        self.sent = sent
+        self.received = None
+        self.distance = distance
+        self.outcome = None
+        self.nodes = []
+
+    @property
+    def duration(self):
+        if self.received is None:
+            return None
+        return self.received - self.sent
+
+    def __repr__(self):
+        return "Hop({0}, {1}, {2:.3f}s, distance 2**{3}, {4} nodes)".format(
+            self.c, self.outcome, self.duration or 0.0,
+            self.distance.bit_length(), len(self.nodes))
+
+
+class LookupTrace(object):
+    """
+        Record of a single find_node or get_peers lookup, filled in by
+        the DHT as the lookup goes.
+
+        result is "found" when the lookup got what it was looking for,
+        "cached" when it was answered from the lookup cache,
+        "exhausted" when it ran out of attempts, and "error" when it
+        failed otherwise, e.g. for want of nodes to query.
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self.target = None
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.hops = []
+        # Closest distance to the target reached after each hop
+        self.progress = []
+
+    def start(self, target):
+        self.target = target
+        self.started = self._clock()
+
+    def hop(self, node_id, c):
+        h = Hop(node_id, c, self._clock(), distance(node_id, self.target))
+        self.hops.append(h)
+        return h
+
+    def done(self, hop, outcome, nodes=()):
+        hop.received = self._clock()
+        hop.outcome = outcome
+        hop.nodes = list(nodes)
+        best = self.progress[-1] if self.progress else hop.distance
+        if outcome == "reply":
+            best = min(best, hop.distance)
+        self.progress.append(best)
+
+    def finish(self, result):
+        self.finished = self._clock()
+        self.result = result
+
+    @property
+    def duration(self):
+        if self.finished is None or self.started is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def routing_hops(self):
+        """
+            Number of replies that got us closer to the target than any
+            before; the hops of the lookup proper, as opposed to all the
+            queries made (len(hops)).
+        """
+        n = 0
+        best = None
+        for h in self.hops:
+            if h.outcome == "reply" and (best is None or h.distance < best):
+                best = h.distance
+                n += 1
+        return n
+
+    def summary(self):
+        outcomes = {"reply": 0, "timeout": 0, "error": 0}
+        waited = dict.fromkeys(outcomes, 0.0)
+        for h in self.hops:
+            outcomes[h.outcome] = outcomes.get(h.outcome, 0) + 1
+            waited[h.outcome] = waited.get(h.outcome, 0.0) + (h.duration or 0.0)
+        return {"result": self.result,
+                "duration": self.duration,
+                "hops": len(self.hops),
+                "routing_hops": self.routing_hops,
+                "outcomes": outcomes,
+                "time_per_outcome": waited,
+                "closest": self.progress[-1].bit_length() if self.progress else None}
+
+
+class Hooks(object):
+    """
+        Callbacks fired around the hot path:
+
+            "decode"    bdecoding an incoming packet
+            "dispatch"  handing an incoming query to the request handler
+            "routing"   every routing table call (see instrument())
+
+        Each hook is a pair of enter(point, name) and exit(point, name)
+        callables; either may be None. name is the query or method name
+        where there is one. Evaluates as false while no hooks are set, so
+        callers can skip the calls entirely.
+    """
+    POINTS = ("decode", "dispatch", "routing")
+
+    def __init__(self):
+        self._enter = dict((p, []) for p in self.POINTS)
+        self._exit = dict((p, []) for p in self.POINTS)
+        self._count = 0
+
+    def __bool__(self):
+        return self._count > 0
+
+    def add(self, point, enter=None, exit=None):
+        if point not in self.POINTS:
+            raise ValueError("Unknown hook point %r" % point)
+        if enter is not None:
+            self._enter[point].append(enter)
+        if exit is not None:
+            # Exit hooks run in reverse order of registration
+            self._exit[point].insert(0, exit)
+        self._count += 1
+
+    def clear(self):
+        for p in self.POINTS:
+            self._enter[p] = []
+            self._exit[p] = []
+        self._count = 0
+
+    def active(self, point):
+        return bool(self._enter[point] or self._exit[point])
+
+    def enter(self, point, name=None):
+        for fn in self._enter[point]:
+            fn(point, name)
+
+    def exit(self, point, name=None):
+        for fn in self._exit[point]:
+            fn(point, name)
+
+    def instrument(self, rt):
+        """ Wrap routing table rt so that "routing" hooks fire around its calls """
+        return HookedRoutingTable(rt, self)
+
+
+class HookedRoutingTable(object):
+    """
+        Proxy for a routing table that fires "routing" hooks around every
+        method call.
+    """
+    def __init__(self, rt, hooks):
+        self._rt = rt
+        self._hooks = hooks
+
+    def __getattr__(self, name):
+        attr = getattr(self._rt, name)
+        if not callable(attr) or name.startswith("__"):
+            return attr
+        hooks = self._hooks
+
+        def hooked(*args, **kwargs):
+            hooks.enter("routing", name)
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                hooks.exit("routing", name)
+        return hooked
@@ -0,0 +1,113 @@
+"""
+    Bookkeeping of outstanding KRPC transactions.
+"""
+import collections
+import struct
+import threading
+
+_TID = struct.Struct("!H")
+
+
+class Transaction(object):
+    """
+        An outstanding query. callback is None for synchronous queries,
+        whose reply (or error) is left in result for the waiting thread.
+    """
+    __slots__ = ["callback", "node", "sent", "result"]
+
+    def __init__(self, callback, node, sent):
+        self.callback = callback
+        self.node = node
+        self.sent = sent
+        self.result = None
+
+
+class TransactionTable(object):
+    """
+        Allocates 2 byte transaction IDs, which are indices into a slot
+        array, so matching a reply to its query is a list lookup.
+
+        Freed IDs go to the back of a free list and are handed out again
+        only after every other free ID was, which keeps a late reply from
+        matching a new transaction for as long as possible. Replies are
+        also only matched when they come from the address the query went
+        to.
+
+        Asynchronous transactions that get no reply within timeout seconds
+        are expired by expire(). Synchronous ones are released by the
+        thread waiting for them.
+    """
+    def __init__(self, timeout=10.0, size=1 << 16):
+        self.timeout = timeout
+        self.size = size
+        self._slots = [None] * size
+        self._free = collections.deque(range(size))
+        # (deadline, index, transaction), in order of deadline
+        self._expiry = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size - len(self._free)
+
+    def add(self, callback, node, sent):
+        """
+            Register a new transaction, return its transaction ID.
+            Raises IndexError if all IDs are in use.
+        """
+        tr = Transaction(callback, node, sent)
+        with self._lock:
+            if not self._free:
+                self._expire(sent)
+            index = self._free.popleft()
+            self._slots[index] = tr
+            if callback is not None:
+                self._expiry.append((sent + self.timeout, index, tr))
+        return _TID.pack(index)
+
+    def get(self, t):
+        """ The outstanding Transaction with ID t, or None """
+        if len(t) != 2:
+            return None
+        return self._slots[_TID.unpack(t)[0]]
+
+    def match(self, t, c):
+        """
+            The outstanding Transaction with ID t sent to connect_info c,
+            or None.
+        """
+        if len(t) != 2:
+            return None
+        tr = self._slots[_TID.unpack(t)[0]]
+        if tr is None or tr.node.c != c:
+            return None
+        return tr
+
+    def release(self, t, tr):
+        """ Free the ID t, if it still belongs to tr """
+        index = _TID.unpack(t)[0]
+        with self._lock:
+            if self._slots[index] is tr:
+                self._slots[index] = None
+                self._free.append(index)
+
+    def expire(self, now):
+        """
+            Free asynchronous transactions older than timeout.
+            Returns how many were freed.
+        """
+        if not self._expiry or self._expiry[0][0] >= now:
+            return 0
+        with self._lock:
+            return self._expire(now)
+
+    def _expire(self, now):
+        # Must be called with _lock held
+        expired = 0
+        expiry, slots = self._expiry, self._slots
+        while expiry and expiry[0][0] < now:
+            _, index, tr = expiry.popleft()
+            if slots[index] is tr:
+                slots[index] = None
+                self._free.append(index)
+                expired += 1
+        return expired
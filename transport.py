@@ -0,0 +1,111 @@
+"""
+    Transports carry KRPC packets for a KRPCServer.
+
+    A transport provides:
+
+        start(port)         start listening on port
+        recvfrom(bufsize)   return (data, connect_info), or raise
+                            socket.timeout if nothing arrives for a while
+        sendto(data, c)     send data to connect_info c
+        close()
+        time()              the current time, in seconds
+        sleep(seconds)      wait, while packets keep being received
+
+    connect_info is always an (ip, port) pair; IPv6 addresses are told
+    apart by the ":" in them.
+
+    UDPTransport is the real thing. The simulator module has one that
+    runs on a virtual clock instead.
+"""
+import collections
+import logging
+import select
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def is_ipv6(ip):
+    return ":" in ip
+
+
+class UDPTransport(object):
+    """
+        UDP on an IPv4 socket and, with ipv6 set, an IPv6 socket on the
+        same port. Packets to IPv6 addresses go out the IPv6 socket.
+
+        With both sockets open, recvfrom() reads a packet from each one
+        that is readable and hands them out in turn, so a busy socket
+        cannot starve the other.
+    """
+    def __init__(self, host="0.0.0.0", timeout=0.5, ipv6=False, host6="::"):
+        self._host = host
+        self._host6 = host6
+        self._timeout = timeout
+        self._ipv6 = ipv6
+        self._sock = None
+        self._sock6 = None
+        # Packets read but not handed out yet
+        self._pending = collections.deque()
+
+    def start(self, port):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.settimeout(self._timeout)
+        self._sock.bind((self._host, port))
+        if self._ipv6:
+            # Use the port we actually got, in case port was 0
+            port = self._sock.getsockname()[1]
+            try:
+                sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                sock6.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                sock6.bind((self._host6, port))
+                self._sock6 = sock6
+            except OSError as e:
+                logger.warning("IPv6 unavailable, continuing on IPv4 only: {0}".format(e))
+
+    @property
+    def ipv6(self):
+        return self._sock6 is not None
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def recvfrom(self, bufsize):
+        if self._sock6 is None:
+            return self._sock.recvfrom(bufsize)
+        pending = self._pending
+        if not pending:
+            readable, _, _ = select.select([self._sock, self._sock6], [], [], self._timeout)
+            if not readable:
+                raise socket.timeout()
+            for sock in readable:
+                try:
+                    data, c = sock.recvfrom(bufsize)
+                except OSError:
+                    if not pending:
+                        raise
+                    continue
+                # IPv6 addresses come with flow info and scope id, drop those
+                pending.append((data, c[:2]))
+        return pending.popleft()
+
+    def sendto(self, data, c):
+        if is_ipv6(c[0]):
+            if self._sock6 is None:
+                raise OSError("Cannot send to {0}: IPv6 is not enabled".format(c))
+            self._sock6.sendto(data, c)
+        else:
+            self._sock.sendto(data, c)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        if self._sock6 is not None:
+            self._sock6.close()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)